@@ -0,0 +1,323 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Benchmarks of repex's hot paths over synthetic trees of files.
+
+Each benchmark is run `--repeat` times and its median run is reported
+and compared with the stored baseline. Files are recreated before each
+run, outside of the measured time, and logging is disabled so that it
+doesn't dominate the results.
+
+    python benchmarks/benchmark_repex.py
+    python benchmarks/benchmark_repex.py --save
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import collections
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import repex  # NOQA
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+FILE_NAME = 'VERSION'
+VERSION_LINE = '"version": "3.1.0-m2"\n'
+FILLER_LINE = '"description": "nothing to see in this line of the file"\n'
+
+
+def _write_file(path, lines):
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def _create_wide_tree(base_dir, dirs=50, files_per_dir=40):
+    """Many small files in many sibling directories, a fifth of which
+    are files to handle.
+    """
+    for dir_index in range(dirs):
+        directory = os.path.join(base_dir, 'dir{0}'.format(dir_index))
+        os.makedirs(directory)
+        for file_index in range(files_per_dir):
+            name = FILE_NAME if file_index % 5 == 0 else \
+                'other{0}'.format(file_index)
+            _write_file(os.path.join(directory, '{0}.{1}'.format(
+                name, file_index)), [FILLER_LINE] * 10 + [VERSION_LINE])
+
+
+def _create_deep_tree(base_dir, depth=100, files_per_dir=20):
+    """A single chain of nested directories with a few files in each
+    """
+    directory = base_dir
+    for level in range(depth):
+        directory = os.path.join(directory, 'level{0}'.format(level))
+        os.makedirs(directory)
+        for file_index in range(files_per_dir):
+            _write_file(os.path.join(directory, '{0}.{1}'.format(
+                FILE_NAME, file_index)), [FILLER_LINE, VERSION_LINE])
+
+
+def _create_huge_files(base_dir, count=3, lines=100000):
+    """A few huge files with a single match at their end
+    """
+    for index in range(count):
+        _write_file(os.path.join(base_dir, '{0}.{1}'.format(
+            FILE_NAME, index)), [FILLER_LINE] * lines + [VERSION_LINE])
+
+
+def _create_dense_file(base_dir, lines=100000):
+    """A file in which every line is a match
+    """
+    _write_file(os.path.join(base_dir, FILE_NAME), [VERSION_LINE] * lines)
+
+
+def _path_object(base_dir, **kwargs):
+    return dict({
+        'type': FILE_NAME + r'\.\d+',
+        'path': '.',
+        'base_directory': base_dir,
+        'match': '"version": "3.1.0-m2"',
+        'replace': '3.1.0-m2',
+        'with': '3.1.0-m3',
+    }, **kwargs)
+
+
+def bench_get_all_files_wide(base_dir):
+    _create_wide_tree(base_dir, dirs=250)
+    return None, lambda: repex.get_all_files(
+        FILE_NAME + r'\.\d+', '.', base_dir)
+
+
+def bench_get_all_files_deep(base_dir):
+    _create_deep_tree(base_dir)
+    return None, lambda: repex.get_all_files(
+        FILE_NAME + r'\.\d+', 'level3', base_dir)
+
+
+def bench_get_all_files_gitignore(base_dir):
+    """Source files next to an ignored build directory which dwarfs them
+    """
+    _create_wide_tree(os.path.join(base_dir, 'src'), dirs=10)
+    _create_wide_tree(os.path.join(base_dir, 'build'), dirs=250)
+    _write_file(os.path.join(base_dir, '.gitignore'), ['/build/\n'])
+    return None, lambda: repex.get_all_files(
+        FILE_NAME + r'\.\d+', '.', base_dir, gitignore=True)
+
+
+def bench_get_all_files_many_excluded(base_dir):
+    _create_wide_tree(base_dir, dirs=100)
+    excluded_paths = \
+        ['dir{0}/{1}.0'.format(index, FILE_NAME) for index in range(300)] + \
+        ['generated{0}'.format(index) for index in range(300)]
+    return None, lambda: repex.get_all_files(
+        FILE_NAME + r'\.\d+', '.', base_dir, excluded_paths)
+
+
+def bench_find_matches_dense(base_dir):
+    _create_dense_file(base_dir)
+    with open(os.path.join(base_dir, FILE_NAME)) as f:
+        content = f.read()
+    rpx = repex.Repex('"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m3')
+    return None, lambda: rpx.find_matches(content, FILE_NAME)
+
+
+def bench_handle_file_dense(base_dir):
+    file_path = os.path.join(base_dir, FILE_NAME)
+    rpx = repex.Repex('"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m3')
+    return (lambda: _create_dense_file(base_dir),
+            lambda: rpx.handle_file(file_path))
+
+
+def bench_handle_file_dense_literal(base_dir):
+    file_path = os.path.join(base_dir, FILE_NAME)
+    rpx = repex.Repex(
+        '"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m3', literal=True)
+    return (lambda: _create_dense_file(base_dir),
+            lambda: rpx.handle_file(file_path))
+
+
+def bench_handle_file_huge(base_dir):
+    files = [os.path.join(base_dir, '{0}.{1}'.format(FILE_NAME, index))
+             for index in range(3)]
+    rpx = repex.Repex('"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m3',
+                      must_include=['description'])
+
+    def handle_files():
+        for file_path in files:
+            rpx.handle_file(file_path)
+
+    return lambda: _create_huge_files(base_dir), handle_files
+
+
+def bench_handle_file_huge_unmatched(base_dir):
+    _create_huge_files(base_dir)
+    files = [os.path.join(base_dir, '{0}.{1}'.format(FILE_NAME, index))
+             for index in range(3)]
+    rpx = repex.Repex('"version": "9.9.9"', '9.9.9', '3.1.0-m3')
+
+    def handle_files():
+        for file_path in files:
+            rpx.handle_file(file_path)
+
+    return None, handle_files
+
+
+def bench_expand_variables(base_dir):
+    repex_vars = dict(('var{0}'.format(index), 'value{0}'.format(index))
+                      for index in range(100))
+    template = ' '.join(
+        '{{{{ .var{0} }}}}'.format(index) for index in range(0, 100, 10))
+    attributes = _path_object(base_dir, match=template, replace=template,
+                              must_include=[template] * 5)
+
+    def expand():
+        repex.VariablesHandler().expand(repex_vars, json.loads(
+            json.dumps(attributes)))
+
+    return None, expand
+
+
+def _wide_tree_config(base_dir):
+    return {'paths': [
+        _path_object(base_dir),
+        _path_object(base_dir, match='"description": ".*"',
+                     replace='nothing', **{'with': 'something'}),
+        _path_object(base_dir, match='"version": "9.9.9"', replace='9.9.9'),
+    ]}
+
+
+def _recreate_wide_tree(base_dir):
+    shutil.rmtree(base_dir)
+    os.makedirs(base_dir)
+    _create_wide_tree(base_dir)
+
+
+def bench_iterate_wide(base_dir):
+    return lambda: _recreate_wide_tree(base_dir), lambda: repex.iterate(
+        config=_wide_tree_config(base_dir))
+
+
+def bench_iterate_wide_with_workers(base_dir):
+    return lambda: _recreate_wide_tree(base_dir), lambda: repex.iterate(
+        config=_wide_tree_config(base_dir), workers=4)
+
+
+def bench_iterate_many_rules(base_dir):
+    _create_wide_tree(base_dir)
+    config = {'paths': [
+        _path_object(base_dir, match=r'"version": "9\.9\.{0}"'.format(index))
+        for index in range(20)]}
+    return None, lambda: repex.iterate(config=config)
+
+
+BENCHMARKS = collections.OrderedDict(
+    (name[len('bench_'):], function)
+    for name, function in sorted(globals().items())
+    if name.startswith('bench_'))
+
+
+def run_benchmark(name, repeat):
+    """Return the median of `repeat` runs of a benchmark in seconds
+    """
+    base_dir = tempfile.mkdtemp(prefix='repex-benchmark-')
+    try:
+        setup, function = BENCHMARKS[name](base_dir)
+        timings = []
+        for _ in range(repeat):
+            if setup:
+                setup()
+            started = time.time()
+            function()
+            timings.append(time.time() - started)
+        return sorted(timings)[len(timings) // 2]
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def _load_baseline(baseline_file):
+    if not os.path.isfile(baseline_file):
+        return {}
+    with open(baseline_file) as f:
+        return json.load(f)
+
+
+@click.command()
+@click.argument('NAMES', nargs=-1)
+@click.option('-r',
+              '--repeat',
+              default=5,
+              type=click.IntRange(min=1),
+              help='Number of times to run each benchmark. Defaults to 5')
+@click.option('--baseline',
+              default=BASELINE_FILE,
+              help='Path to the baseline file to compare with')
+@click.option('--threshold',
+              default=1.5,
+              type=float,
+              help='Fail if a benchmark is slower than its baseline by '
+                   'this factor. Defaults to 1.5')
+@click.option('--save',
+              default=False,
+              is_flag=True,
+              help='Save the results as the new baseline')
+def main(names, repeat, baseline, threshold, save):
+    """Run all benchmarks (or only `NAMES`) and compare them with
+    a stored baseline.
+    """
+    repex.logger.setLevel(logging.WARNING)
+    unknown_names = set(names) - set(BENCHMARKS)
+    if unknown_names:
+        sys.exit('Unknown benchmarks: {0}'.format(
+            ', '.join(sorted(unknown_names))))
+
+    baseline_results = _load_baseline(baseline)
+    results = {}
+    regressions = []
+    for name in names or BENCHMARKS:
+        results[name] = run_benchmark(name, repeat)
+        baseline_result = baseline_results.get(name)
+        if baseline_result:
+            ratio = results[name] / baseline_result
+            comparison = '{0:.2f}x baseline'.format(ratio)
+            if ratio > threshold:
+                regressions.append(name)
+                comparison += ' REGRESSION'
+        else:
+            comparison = 'no baseline'
+        click.echo('{0:<34} {1:>9.4f}s  {2}'.format(
+            name, results[name], comparison))
+
+    if save:
+        baseline_results.update(
+            (name, round(result, 6)) for name, result in results.items())
+        with open(baseline, 'w') as f:
+            json.dump(baseline_results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        click.echo('Saved baseline to {0}'.format(baseline))
+    elif regressions:
+        sys.exit('Slower than baseline: {0}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,9 +16,26 @@
 import os
 import re
 import sys
-import imp
+import json
+import time
+import pstats
+import cProfile
+import hashlib
+import subprocess
+import mmap
+import codecs
+import difflib
+import locale
 import shutil
+import asyncio
 import logging
+import tempfile
+import collections
+import threading
+import contextlib
+import importlib.util
+import importlib.machinery
+from concurrent import futures
 
 import yaml
 import click
@@ -42,12 +59,30 @@ ERRORS = {
                             'not found',
     'validation_failed': 'Validation failed!',
     'validator_path_not_found': 'Path to validator script not found',
-    'validator_function_not_found': 'Validation function not found in script'
+    'validator_function_not_found': 'Validation function not found in script',
+    'files_failed': 'Failed to handle files',
+    'stream_multiline_regex': '`stream` requires `match` and `must_include` '
+                              'to only match within a single line',
+    'git_diff_failed': 'Failed to list changed files using `git diff`'
 }
 
 
 REPEX_VAR_PREFIX = 'REPEX_VAR_'
 
+REGEX_METACHARACTERS = '.^$*+?{}[]\\|()'
+
+CACHE_FILE_NAME = 'repex-cache.json'
+CACHE_VERSION = 1
+# Files modified this recently may be modified again without their
+# modification time changing, so they're never cached
+CACHE_RACY_SECONDS = 2
+
+IGNORE_FILE_NAMES = ('.gitignore', '.repexignore')
+
+# Files with a null byte in this many first bytes are considered binary,
+# the same as git does
+BINARY_SNIFF_SIZE = 8000
+
 
 def setup_logger():
     handler = logging.StreamHandler(sys.stdout)
@@ -66,6 +101,240 @@ def set_verbose():
     logger.setLevel(logging.DEBUG)
 
 
+@contextlib.contextmanager
+def _logging_to_stderr(enabled=True):
+    """Log to stderr instead of stdout within the block (e.g. so that
+    stdout only has a diff). Does nothing if `enabled` is False.
+    """
+    handlers = [handler for handler in logger.handlers
+                if enabled and isinstance(handler, logging.StreamHandler)]
+    streams = [handler.stream for handler in handlers]
+    for handler in handlers:
+        handler.flush()
+        handler.stream = sys.stderr
+    try:
+        yield
+    finally:
+        for handler, stream in zip(handlers, streams):
+            handler.flush()
+            handler.stream = stream
+
+
+class _WorkerLogBuffer(logging.Filter):
+    """Hold back log records emitted while handling a file in a worker
+    thread so that they can be replayed in order once the file is done.
+    """
+    def __init__(self):
+        super(_WorkerLogBuffer, self).__init__()
+        self._local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def capture(self, func, *args):
+        """Call `func` and return the records it logged, its result and
+        the exception it raised, if any.
+        """
+        self._local.records = []
+        result = error = None
+        try:
+            result = func(*args)
+        except Exception as ex:
+            error = ex
+        finally:
+            records = self._local.records
+            self._local.records = None
+        return records, result, error
+
+
+def _handle_files(files, handle, workers=1):
+    """Call `handle` for each file in `files` using `workers` threads
+    and return the results in the order of `files`.
+
+    Log records are emitted in the order of `files`, regardless of
+    the order in which files are handled. When using more than one
+    worker, all files are handled even if some of them fail and the
+    failures are raised together once done.
+    """
+    return list(_iter_handled_files(files, handle, workers))
+
+
+def _iter_handled_files(files, handle, workers=1):
+    """Yield the results of `_handle_files` one by one, each as soon as
+    all files before it were handled. Once closed, files which were not
+    handled yet are skipped.
+    """
+    if workers <= 1 or len(files) <= 1:
+        # Without workers, the first failure stops the run as is
+        for file_to_handle in files:
+            try:
+                result = handle(file_to_handle)
+            except Exception as ex:
+                logger.error('Failed to handle %s: %s', file_to_handle, ex)
+                raise
+            yield result
+        return
+
+    log_buffer = _WorkerLogBuffer()
+    logger.addFilter(log_buffer)
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    captured = [executor.submit(log_buffer.capture, handle, f)
+                for f in files]
+    failed_files = []
+    try:
+        for file_to_handle, captured_file in zip(files, captured):
+            records, result, error = captured_file.result()
+            for record in records:
+                logger.handle(record)
+            if error:
+                logger.error('Failed to handle %s: %s',
+                             file_to_handle, error)
+                failed_files.append((file_to_handle, error))
+            else:
+                yield result
+    finally:
+        for captured_file in captured:
+            captured_file.cancel()
+        executor.shutdown()
+        logger.removeFilter(log_buffer)
+    if failed_files:
+        raise RepexError('{0}: {1}'.format(
+            ERRORS['files_failed'], ', '.join(
+                '{0} ({1})'.format(path, error)
+                for path, error in failed_files))) from failed_files[0][1]
+
+
+class RegexRegistry(object):
+    """Compiled regexes by pattern.
+
+    A registry is created once per run so that each regex is compiled only
+    once instead of relying on `re`'s small internal cache, no matter how
+    many files or paths it is used for. `hits` and `misses` count the
+    number of lookups which found an already compiled regex and the number
+    which had to compile it.
+    """
+    def __init__(self):
+        self._expressions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, pattern):
+        with self._lock:
+            expression = self._expressions.get(pattern)
+            if expression is None:
+                self.misses += 1
+                expression = re.compile(pattern)
+                self._expressions[pattern] = expression
+            else:
+                self.hits += 1
+            return expression
+
+
+class RunStats(object):
+    """Counters and timings of the phases of a run.
+
+    Phase timings are summed over all workers, so with more than one
+    worker, they may add up to more than the duration of the run.
+
+    Files are counted as walked once per directory listed, as written
+    once per write to disk and as read once each time a path handles
+    them, however many passes that takes.
+    """
+    PHASES = ('expand', 'walk', 'read', 'match', 'write', 'validate')
+    COUNTERS = ('files_walked', 'files_handled', 'files_matched',
+                'files_written', 'bytes_read', 'bytes_written',
+                'files_skipped_size', 'files_skipped_binary',
+                'files_skipped_extension')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self.phases = dict((phase, 0.0) for phase in self.PHASES)
+        self.counters = dict((counter, 0) for counter in self.COUNTERS)
+        self.file_durations = []
+        self._walked_dirs = set()
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            with self._lock:
+                self.phases[phase] += duration
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def add_walked(self, directory, files_count):
+        """Count the files in `directory` unless it was already walked
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if directory not in self._walked_dirs:
+                self._walked_dirs.add(directory)
+                self.counters['files_walked'] += files_count
+
+    def add_written(self, bytes_written):
+        with self._lock:
+            self.counters['files_written'] += 1
+            self.counters['bytes_written'] += bytes_written
+
+    def add_result(self, result):
+        """Count a `FileResult` of a handled file
+        """
+        with self._lock:
+            self.counters['files_handled'] += 1
+            self.counters['files_matched'] += bool(result.matches)
+            self.file_durations.append((result.duration, result.path))
+
+    def get_report(self, slowest_files=10):
+        """Return a JSON serializable dict of all counters, the time
+        spent in each phase and the slowest files handled.
+        """
+        with self._lock:
+            report = dict(self.counters)
+            report['duration'] = time.time() - self._started
+            report['phases'] = dict(self.phases)
+            report['slowest_files'] = [
+                {'path': path, 'duration': duration}
+                for duration, path in sorted(
+                    self.file_durations, reverse=True)[:slowest_files]]
+        return report
+
+    def get_summary(self, slowest_files=5):
+        report = self.get_report(slowest_files)
+        lines = [
+            'Walked {0} files and handled {1} in {2:.3f}s'.format(
+                report['files_walked'], report['files_handled'],
+                report['duration']),
+            '{0} files matched and {1} were written'.format(
+                report['files_matched'], report['files_written']),
+            'Read {0} bytes and wrote {1} bytes'.format(
+                report['bytes_read'], report['bytes_written']),
+            'Skipped {0} files by size, {1} binary files and {2} files '
+            'by extension'.format(
+                report['files_skipped_size'],
+                report['files_skipped_binary'],
+                report['files_skipped_extension']),
+            'Time per phase: {0}'.format(', '.join(
+                '{0} {1:.3f}s'.format(phase, report['phases'][phase])
+                for phase in self.PHASES)),
+        ]
+        if report['slowest_files']:
+            lines.append('Slowest files:')
+            lines.extend('  {0:.3f}s {1}'.format(f['duration'], f['path'])
+                         for f in report['slowest_files'])
+        return '\n'.join(lines)
+
+
 def _import_config_file(config_file_path):
     """Return a configuration object
     """
@@ -92,46 +361,1054 @@ def _get_config(config_file_path=None, config=None):
     return config
 
 
-def _set_excluded_paths(base_dir, excluded_paths):
-    excluded_paths = excluded_paths or []
-    excluded_paths = [os.path.join(base_dir, excluded_path).rstrip('/')
-                      for excluded_path in excluded_paths]
-    return excluded_paths
+def _split_path(path):
+    """Return the components of `path`, ignoring empty and `.` ones,
+    starting with `/` if it's absolute.
+    """
+    path = path.replace(os.sep, '/')
+    components = [c for c in path.split('/') if c and c != '.']
+    return ['/'] + components if path.startswith('/') else components
 
 
-def _set_match_parameters(filename,
-                          filepath,
-                          filename_regex,
-                          excluded_filename_regex,
-                          excluded_paths):
-    filename_regex = r'{0}'.format(filename_regex)
-    excluded_filename_regex = r'{0}'.format(excluded_filename_regex)
+class ExcludedPaths(object):
+    """The paths excluded under `base_dir`, given as explicit paths
+    (even if they include glob characters, e.g. `pages/[id]`) and as
+    `glob` patterns (e.g. `*/build` or `**/*.min.js`).
 
-    is_file = os.path.isfile(filepath)
-    matched = re.match(filename_regex, filename)
-    excluded_filename = re.match(excluded_filename_regex, filename)
-    excluded_path = filepath in excluded_paths
+    Explicit paths are kept in a set and a trie of their components so
+    that looking a path up takes time in proportion to its depth rather
+    than to the number of excluded paths. A path is excluded if it, or
+    any directory it's under, is.
+    """
+    def __init__(self, base_dir, excluded_paths=None, excluded_patterns=None):
+        self.base_components = _split_path(base_dir)
+        self.paths = set()
+        self._trie = {}
+        # Patterns are relative to `base_dir`
+        self._patterns = [
+            _ignore_pattern_to_regex('/' + pattern.replace(os.sep, '/'))[0]
+            for pattern in excluded_patterns or []]
+        for excluded_path in excluded_paths or []:
+            components = _split_path(os.path.join(base_dir, excluded_path))
+            self.paths.add('/'.join(components))
+            node = self._trie
+            for component in components:
+                node = node.setdefault(component, {})
+            node[None] = True
+
+    def __bool__(self):
+        return bool(self.paths or self._patterns)
+
+    def __repr__(self):
+        return repr(sorted(self.paths) + [
+            pattern.pattern for pattern in self._patterns])
+
+    def is_excluded(self, path):
+        """Return whether `path` or any directory it's under is excluded
+        """
+        if not self.paths and not self._patterns:
+            return False
+        components = _split_path(path)
+        node = self._trie
+        for component in components:
+            node = node.get(component)
+            if node is None:
+                break
+            if None in node:
+                return True
+        return self._matches_pattern(components, any_depth=True)
+
+    def is_excluded_file(self, path):
+        """Return whether `path` itself is excluded, regardless of the
+        directories it's under (which are expected to have been looked up
+        while walking).
+        """
+        if not self.paths and not self._patterns:
+            return False
+        components = _split_path(path)
+        return '/'.join(components) in self.paths or \
+            self._matches_pattern(components)
+
+    def _matches_pattern(self, components, any_depth=False):
+        if not self._patterns or \
+                components[:len(self.base_components)] != \
+                self.base_components:
+            return False
+        relative_components = components[len(self.base_components):]
+        depths = range(1, len(relative_components) + 1) if any_depth \
+            else [len(relative_components)]
+        for depth in depths:
+            relative_path = '/'.join(relative_components[:depth])
+            if any(pattern.match(relative_path)
+                   for pattern in self._patterns):
+                return True
+        return False
+
+
+def _set_match_parameters(file_entry,
+                          filename_expression,
+                          excluded_filename_expression,
+                          excluded_paths):
+    filename = file_entry.name
+    is_file = file_entry.is_file()
+    matched = filename_expression.match(filename)
+    excluded_filename = excluded_filename_expression and \
+        excluded_filename_expression.match(filename)
+    excluded_path = bool(matched) and \
+        excluded_paths.is_excluded_file(file_entry.path)
     return is_file, matched, excluded_filename, excluded_path
 
 
+def _get_anchored_prefix(regex):
+    """Return the literal prefix which any string matched by `regex`
+    must start with.
+
+    This is only possible if `regex` is anchored to the beginning of
+    the string (`^`) and has no alternations. None is returned otherwise.
+    """
+    if not regex.startswith('^') or '|' in regex:
+        return None
+    prefix = []
+    index = 1
+    while index < len(regex):
+        char = regex[index]
+        if char == '\\':
+            char = regex[index + 1:index + 2]
+            # `\d`, `\w`, `\1`, etc.. are not literals
+            if not char or char.isalnum():
+                break
+            index += 2
+        elif char in REGEX_METACHARACTERS:
+            break
+        else:
+            index += 1
+        # A quantified char might not be there at all
+        if regex[index:index + 1] in ('*', '?', '{'):
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+def _get_literal(regex):
+    """Return the string `regex` matches if it has no metacharacters
+    (other than escaped punctuation), or None otherwise.
+    """
+    literal = []
+    index = 0
+    while index < len(regex):
+        char = regex[index]
+        if char == '\\':
+            char = regex[index + 1:index + 2]
+            if not char or char.isalnum():
+                return None
+            index += 1
+        elif char in REGEX_METACHARACTERS:
+            return None
+        literal.append(char)
+        index += 1
+    return ''.join(literal)
+
+
+def _get_required_literal(regex):
+    """Return the longest literal string which any string matched by
+    `regex` must contain, or None if there's none.
+
+    This errs on the side of caution: alternations, flags and
+    lookarounds make it give up entirely.
+    """
+    if '|' in regex:
+        return None
+    literals = ['']
+    group_starts = []
+    index = 0
+    while index < len(regex):
+        char = regex[index]
+        index += 1
+        if char == '\\':
+            char = regex[index:index + 1]
+            index += 1
+            if not char or char.isalnum():
+                literals.append('')
+                continue
+        elif char in '*?+{':
+            if char == '{':
+                end = regex.find('}', index)
+                if end == -1 or not re.match(
+                        r'^\d*,?\d*$', regex[index:end]):
+                    literals[-1] += char
+                    continue
+                index = end + 1
+            # A quantified char might not be there at all
+            if char != '+':
+                literals[-1] = literals[-1][:-1]
+            literals.append('')
+            continue
+        elif char == '[':
+            # A `]` right after the opening `[` or `[^` is a literal
+            if regex.startswith('^', index):
+                index += 1
+            if regex.startswith(']', index):
+                index += 1
+            while index < len(regex) and regex[index] != ']':
+                index += 2 if regex[index] == '\\' else 1
+            index += 1
+            literals.append('')
+            continue
+        elif char == '(':
+            if regex.startswith('?P=', index):
+                index = regex.find(')', index) + 1
+                literals.append('')
+                continue
+            if regex.startswith('?:', index):
+                index += 2
+            elif regex.startswith('?P<', index):
+                index = regex.find('>', index) + 1
+            elif regex.startswith('?', index):
+                return None
+            group_starts.append(len(literals))
+            literals.append('')
+            continue
+        elif char == ')':
+            if not group_starts:
+                return None
+            group_start = group_starts.pop()
+            # A quantified group might not be there at all
+            if regex.startswith('{', index):
+                end = regex.find('}', index + 1)
+                if end != -1 and re.match(
+                        r'^\d*,?\d*$', regex[index + 1:end]):
+                    del literals[group_start:]
+                    index = end + 1
+            elif regex[index:index + 1] in ('*', '?'):
+                del literals[group_start:]
+                index += 1
+            literals.append('')
+            continue
+        elif char in '.^$\r\n':
+            literals.append('')
+            continue
+        literals[-1] += char
+    return max(literals, key=len) or None
+
+
+def _may_match_newline(regex):
+    """Return whether `regex` might match a line break or behave
+    differently when applied to a single line rather than a whole file.
+
+    This errs on the side of caution: character classes, escapes, flags
+    and anchors which might do so are all treated as if they do.
+    """
+    return bool(re.search(
+        r'\\[nrsWDZA0-9xuUN]|\[\^|\(\?|[\^$\n]', regex))
+
+
+# Besides what a single byte matches, a single character of the decoded
+# content might be a multi-byte UTF-8 sequence or a `\r\n` newline.
+BYTES_ANY_CHAR = r'\r\n|[\xc0-\xff][\x80-\xbf]*'
+BYTES_NEWLINE = r'(?:\r\n|\r(?!\n)|\n)'
+
+
+def _to_bytes_regex(regex):
+    r"""Translate `regex` to a bytes regex for the UTF-8 encoded content
+    of a file opened in text mode (with universal newlines).
+
+    The bytes regex matches wherever `regex` matches the decoded content,
+    but might also match where it doesn't (e.g. `\d` also matches any
+    non-ASCII character).
+
+    Returns a tuple of the compiled bytes regex, or None if `regex` can't
+    be translated, and whether it matches exactly where `regex` does.
+    """
+    tokens = []
+    exact = True
+    index = 0
+    while index < len(regex):
+        char = regex[index]
+        if char == '\\':
+            char = regex[index + 1:index + 2]
+            index += 2
+            if not char or char in 'uUNr':
+                return None, False
+            elif char in 'dDwWsS':
+                tokens.append('(?:{0}|\\{1})'.format(BYTES_ANY_CHAR, char))
+                exact = False
+            elif char in 'bB':
+                # Dropping word boundaries only makes it match more
+                exact = False
+            elif char == 'n':
+                tokens.append(BYTES_NEWLINE)
+            elif ord(char) > 127:
+                tokens.append(_escape_bytes(char))
+            else:
+                tokens.append('\\' + char)
+            continue
+        elif char == '[':
+            # A `]` right after the opening `[` or `[^` is a literal
+            start = index + 2 if regex.startswith('[^', index) else index + 1
+            end = regex.find(']', start + 1)
+            character_class = regex[index:end + 1]
+            if end == -1 or '\\' in character_class or \
+                    any(ord(c) > 127 for c in character_class):
+                return None, False
+            if character_class.startswith('[^'):
+                tokens.append('(?:{0}|{1})'.format(
+                    BYTES_ANY_CHAR, character_class))
+                exact = False
+            else:
+                tokens.append(character_class)
+            index = end + 1
+            continue
+        elif char == '.':
+            tokens.append('(?:{0}|.)'.format(BYTES_ANY_CHAR))
+            exact = False
+        elif char == '$':
+            tokens.append(r'(?=(?:\r\n|\r|\n)?\Z)')
+            exact = False
+        elif char == '\n':
+            tokens.append(BYTES_NEWLINE)
+        elif char == '(' and regex.startswith('(?', index):
+            # Only non-capturing and named groups. No flags or lookarounds
+            if regex.startswith('(?:', index):
+                end = index + 2
+            elif regex.startswith(('(?P<', '(?P='), index):
+                end = regex.find('>' if regex[index + 3] == '<' else ')',
+                                 index)
+            else:
+                return None, False
+            if end == -1:
+                return None, False
+            tokens.append(regex[index:end + 1])
+            index = end + 1
+            continue
+        elif ord(char) > 127:
+            tokens.append(_escape_bytes(char))
+        else:
+            tokens.append(char)
+        index += 1
+    try:
+        return re.compile(''.join(tokens).encode('ascii')), exact
+    except re.error:
+        return None, False
+
+
+def _escape_bytes(char):
+    return '(?:{0})'.format(''.join(
+        '\\x{0:02x}'.format(byte) for byte in bytearray(char.encode('utf-8'))))
+
+
+def _is_text_encoding_utf8():
+    encoding = locale.getpreferredencoding(False)
+    return codecs.lookup(encoding).name == 'utf-8'
+
+
+class DirectoryIndex(object):
+    """The entries of all directories listed during a run.
+
+    Each directory is only listed once, no matter how many paths in the
+    config are looked for under it. The index reflects the directories
+    as they were when first listed.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    def scandir(self, path):
+        """Return a list of the `os.DirEntry` objects in `path`.
+
+        An OSError is raised, every time, if `path` can't be listed.
+        """
+        if path not in self._entries:
+            try:
+                with os.scandir(path) as entries:
+                    self._entries[path] = list(entries)
+            except OSError as ex:
+                self._entries[path] = ex
+        entries = self._entries[path]
+        if isinstance(entries, OSError):
+            raise entries
+        return entries
+
+    def forget(self, path):
+        """Forget the entries of `path`, however it was spelled when
+        listed, so that it's listed again.
+        """
+        path = os.path.abspath(path)
+        for listed_path in list(self._entries):
+            if os.path.abspath(listed_path) == path:
+                del self._entries[listed_path]
+
+
+class FileBuffer(object):
+    """The content of files replaced in during a run which wasn't
+    written yet.
+
+    Each file is read when it's handled by a path and is only kept in the
+    buffer once it's changed, so that paths handled later on replace
+    within the buffered content and the file is written at most once,
+    when the buffer is flushed. Files left unchanged are released as soon
+    as they're handled, so that only changed files are held in memory,
+    at the cost of reading unchanged files again for each path handling
+    them. Once a file is changed, only a digest of its original content
+    is kept to tell whether it's still changed.
+
+    In a dry run, nothing is ever written. All changed files, including
+    those written to another file, are kept in the buffer instead, along
+    with their original content, so that their changes can be listed
+    using `get_changes`.
+    """
+    def __init__(self, dry_run=False, stats=None):
+        self.dry_run = dry_run
+        self.stats = stats or RunStats()
+        # Each entry is the path, original content (or its digest),
+        # current content and whether the two differ
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, file_path):
+        return os.path.abspath(file_path) in self._files
+
+    def is_changed(self, file_path):
+        """Return whether the buffered content of `file_path` differs
+        from the file on disk.
+        """
+        with self._lock:
+            buffered_file = self._files.get(os.path.abspath(file_path))
+        return bool(buffered_file) and buffered_file[3]
+
+    def read(self, file_path):
+        key = os.path.abspath(file_path)
+        with self._lock:
+            if key in self._files:
+                return self._files[key][2]
+        with self.stats.timed('read'):
+            with open(file_path) as f:
+                self.stats.count('bytes_read', os.fstat(f.fileno()).st_size)
+                content = f.read()
+        with self._lock:
+            self._files.setdefault(key, [file_path, content, content, False])
+        return content
+
+    def write(self, file_path, content):
+        """Replace the buffered content of `file_path` with `content`.
+
+        If it isn't buffered yet (e.g. a new `to_file`), its current
+        content (or None if it doesn't exist) is kept as its original one.
+        """
+        key = os.path.abspath(file_path)
+        if key not in self:
+            original_content = None
+            if os.path.isfile(file_path):
+                with open(file_path) as f:
+                    original_content = f.read()
+            with self._lock:
+                self._files.setdefault(
+                    key,
+                    [file_path, original_content, original_content, False])
+        with self._lock:
+            buffered_file = self._files[key]
+            original = buffered_file[1]
+            if not self.dry_run and isinstance(original, str):
+                original = buffered_file[1] = _get_digest(original)
+            if isinstance(original, bytes):
+                buffered_file[3] = _get_digest(content) != original
+            else:
+                buffered_file[3] = content != original
+            buffered_file[2] = content
+
+    def release(self, file_path):
+        """Drop `file_path` from the buffer unless it was changed
+        """
+        key = os.path.abspath(file_path)
+        with self._lock:
+            buffered_file = self._files.get(key)
+            if buffered_file and not buffered_file[3]:
+                del self._files[key]
+
+    def get_changes(self):
+        """Return a `FileChange` for each buffered file whose content
+        differs from the file on disk.
+
+        Outside of a dry run, the original content of files isn't kept,
+        so their `old_content` is None.
+        """
+        with self._lock:
+            return [FileChange(
+                file_path,
+                None if isinstance(original, bytes) else original,
+                content)
+                for file_path, original, content, changed
+                in self._files.values() if changed]
+
+    def flush(self, workers=1):
+        """Write all buffered files whose content changed and empty
+        the buffer. In a dry run, this does nothing.
+        """
+        if self.dry_run:
+            return
+        changes = self.get_changes()
+        with self._lock:
+            self._files.clear()
+        contents = dict((change.path, change.new_content)
+                        for change in changes)
+
+        def write(file_path):
+            logger.debug('Writing output to %s...', file_path)
+            with self.stats.timed('write'):
+                with _open_output(file_path, file_path,
+                                  self.stats) as output:
+                    output.write(contents[file_path])
+
+        _handle_files([change.path for change in changes], write, workers)
+
+
+def _get_digest(content):
+    return hashlib.sha1(content.encode('utf-8', 'surrogatepass')).digest()
+
+
+def get_diff(file_change):
+    """Return a unified diff of the content of a `FileChange`
+    """
+    old_lines = (file_change.old_content or '').splitlines(True)
+    new_lines = file_change.new_content.splitlines(True)
+    from_file = file_change.path if file_change.old_content is not None \
+        else os.devnull
+    return ''.join(difflib.unified_diff(
+        old_lines, new_lines, from_file, file_change.path))
+
+
+class MatchCache(object):
+    """A persistent record of the files which were known to have nothing
+    to replace in them for a specific rule, kept in `cache_dir`.
+
+    A file is skipped without being read if its size, modification time
+    and inode are the same as when it was recorded for the same rule.
+    A rule is the `match`, `replace`, `with`, `to_file` and `must_include`
+    of a path after expanding its variables, so changing any of them
+    invalidates the cache for it.
+
+    Only the entries used during a run are saved, so entries of files
+    or rules which are no longer handled are dropped.
+    """
+    def __init__(self, cache_dir):
+        self.cache_file_path = os.path.join(cache_dir, CACHE_FILE_NAME)
+        self._entries = self._load()
+        self._used_entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        try:
+            with open(self.cache_file_path) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError) as ex:
+            logger.debug('Could not load cache %s: %s',
+                         self.cache_file_path, ex)
+            return {}
+        if not isinstance(cache, dict) or \
+                cache.get('version') != CACHE_VERSION:
+            logger.debug('Ignoring cache %s of a different version',
+                         self.cache_file_path)
+            return {}
+        return cache.get('entries', {})
+
+    @staticmethod
+    def get_rule_key(*rule):
+        return hashlib.sha1(
+            json.dumps(rule, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_signature(file_path):
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def is_known_unmatched(self, file_path, rule_key, signature):
+        key = '{0}:{1}'.format(rule_key, os.path.abspath(file_path))
+        with self._lock:
+            if self._entries.get(key) == signature:
+                self.hits += 1
+                self._used_entries[key] = signature
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, file_path, rule_key, signature):
+        if time.time() - signature[1] / 1e9 < CACHE_RACY_SECONDS:
+            logger.debug('%s was modified too recently to be cached',
+                         file_path)
+            return
+        key = '{0}:{1}'.format(rule_key, os.path.abspath(file_path))
+        with self._lock:
+            self._used_entries[key] = signature
+
+    def save(self):
+        """Write the entries used during the run to the cache file
+        and log how many files were skipped using it.
+        """
+        logger.info('Skipped %s of %s files known to have nothing to '
+                    'replace using cache %s', self.hits,
+                    self.hits + self.misses, self.cache_file_path)
+        cache_dir = os.path.dirname(self.cache_file_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp_file_path = tempfile.mkstemp(
+            prefix=CACHE_FILE_NAME + '.', suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump({'version': CACHE_VERSION,
+                           'entries': self._used_entries}, temp_file)
+            os.replace(temp_file_path, self.cache_file_path)
+        finally:
+            if os.path.isfile(temp_file_path):
+                os.remove(temp_file_path)
+
+
+class LiteralPrefilter(object):
+    """The literals which the `match` of each path of a run requires,
+    and which of them each file includes.
+
+    Instead of each path searching a file for the literal it requires,
+    the first path to look the file up searches it for the literals of
+    all paths at once, in a single scan. Paths handled later on then know
+    right away whether they might have matches in it, without opening it,
+    as long as its size, modification time and inode didn't change since.
+    """
+    def __init__(self, literals):
+        self.literals = set(literal for literal in literals if literal)
+        bytes_literals = sorted(
+            (literal.encode('utf-8') for literal in self.literals),
+            key=len, reverse=True)
+        # Captures the longest literal wherever any literal starts,
+        # without consuming it, so that overlapping literals are all found.
+        # Any other literal starting there is a prefix of the captured one.
+        self._expression = re.compile(b'(?=(' + b'|'.join(
+            re.escape(literal) for literal in bytes_literals) + b'))')
+        self._prefixes = dict(
+            (literal, set(prefix.decode('utf-8') for prefix in bytes_literals
+                          if literal.startswith(prefix)))
+            for literal in bytes_literals)
+        self._files = {}
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.hits = 0
+
+    @classmethod
+    def from_paths(cls, repex_paths, variables=None, regexes=None):
+        """Return a prefilter of the literals required by the `match` of
+        each of `repex_paths`, once their variables are expanded.
+        """
+        variable_expander = VariablesHandler(regexes)
+        literals = []
+        for path in repex_paths:
+            match = variable_expander.expand(
+                variables or {}, {'match': path['match']})['match']
+            literals.append(_get_required_literal(
+                re.escape(match) if path.get('literal') else match))
+        return cls(literals)
+
+    def may_include(self, file_path, literal):
+        """Return whether `file_path`, which must be UTF-8 encoded,
+        might include `literal`.
+        """
+        if literal not in self.literals:
+            return True
+        key = os.path.abspath(file_path)
+        signature = MatchCache.get_signature(file_path)
+        with self._lock:
+            entry = self._files.get(key)
+        if entry and entry[0] == signature:
+            with self._lock:
+                self.hits += 1
+        else:
+            entry = signature, self._scan(file_path)
+            with self._lock:
+                self.scans += 1
+                self._files[key] = entry
+        return literal in entry[1]
+
+    def _scan(self, file_path):
+        """Return the literals included in `file_path`, searching
+        a memory map of its content for all of them in a single scan.
+        """
+        found = set()
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return found
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for match in self._expression.finditer(content):
+                    found.update(self._prefixes[match.group(1)])
+                    if len(found) == len(self.literals):
+                        break
+            finally:
+                content.close()
+        return found
+
+
+class FileFilter(object):
+    """Filters of the files found while walking, applied once their
+    name is chosen, which skip files which shouldn't be handled as text.
+
+    :param int min_size: skip files smaller than this many bytes
+    :param int max_size: skip files larger than this many bytes
+    :param bool skip_binary: skip files with a null byte in their first
+     `BINARY_SNIFF_SIZE` bytes
+    :param list skipped_extensions: skip files with these extensions
+     (e.g. `png`, `.pyc` or `tar.gz`), regardless of case
+    """
+    def __init__(self,
+                 min_size=None,
+                 max_size=None,
+                 skip_binary=False,
+                 skipped_extensions=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.skip_binary = skip_binary
+        self.skipped_extensions = tuple(
+            '.' + extension.lstrip('.').lower()
+            for extension in skipped_extensions or [])
+
+    @classmethod
+    def from_path(cls, pathobj):
+        """Return the filter configured for a path, or None if it has none
+        """
+        file_filter = cls(pathobj.get('min_size'),
+                          pathobj.get('max_size'),
+                          pathobj.get('skip_binary', False),
+                          pathobj.get('skipped_extensions'))
+        return file_filter if file_filter else None
+
+    def __bool__(self):
+        return self.min_size is not None or self.max_size is not None or \
+            self.skip_binary or bool(self.skipped_extensions)
+
+    def get_skip_reason(self, file_entry):
+        """Return why `file_entry` should be skipped (`extension`, `size`
+        or `binary`), or None if it shouldn't.
+
+        Cheaper filters are applied first. The size is taken from the
+        stat of the entry, which is cached once taken, and only files
+        which pass all other filters are opened to look for null bytes.
+        """
+        if self.skipped_extensions and \
+                file_entry.name.lower().endswith(self.skipped_extensions):
+            return 'extension'
+        if self.min_size is not None or self.max_size is not None:
+            size = file_entry.stat().st_size
+            if self.min_size is not None and size < self.min_size or \
+                    self.max_size is not None and size > self.max_size:
+                return 'size'
+        if self.skip_binary and _is_binary(file_entry.path):
+            return 'binary'
+        return None
+
+
+def _is_binary(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return b'\0' in f.read(BINARY_SNIFF_SIZE)
+    except (IOError, OSError):
+        # Whatever went wrong is reported once the file is handled
+        return False
+
+
+def _ignore_pattern_to_regex(pattern):
+    """Translate a pattern of an ignore file to a regex matching paths,
+    relative to the directory of the ignore file and separated by `/`,
+    which the pattern matches.
+
+    Returns a tuple of the regex, whether the pattern is negated (`!`)
+    and whether it only matches directories (trailing `/`), or None if
+    the line has no pattern (e.g. a comment).
+    """
+    pattern = pattern.rstrip('\n\r')
+    if not pattern.endswith('\\ '):
+        pattern = pattern.rstrip(' ')
+    if not pattern or pattern.startswith('#'):
+        return None
+    negated = pattern.startswith('!')
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith(('\\#', '\\!')):
+        pattern = pattern[1:]
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+    # Patterns with a `/` other than a trailing one are relative to the
+    # ignore file. Others match a name at any depth below it.
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    tokens = [] if anchored else ['(?:.*/)?']
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith('**', index) and \
+                (index == 0 or pattern[index - 1] == '/'):
+            if pattern.startswith('**/', index):
+                tokens.append('(?:.*/)?')
+                index += 3
+                continue
+            if index + 2 == len(pattern):
+                tokens.append('.*')
+                index += 2
+                continue
+        if char == '*':
+            tokens.append('[^/]*')
+        elif char == '?':
+            tokens.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', index + 2)
+            if end == -1:
+                tokens.append(re.escape(char))
+            else:
+                character_class = pattern[index + 1:end]
+                if character_class.startswith('!'):
+                    character_class = '^' + character_class[1:]
+                tokens.append('[{0}]'.format(
+                    character_class.replace('\\', '\\\\')))
+                index = end
+        elif char == '\\' and index + 1 < len(pattern):
+            index += 1
+            tokens.append(re.escape(pattern[index]))
+        else:
+            tokens.append(re.escape(char))
+        index += 1
+    return re.compile('^{0}$'.format(''.join(tokens))), negated, \
+        directory_only
+
+
+class IgnoreRules(object):
+    """The rules of the `.gitignore` and `.repexignore` files which apply
+    to the files and directories under `base_dir`, with their `glob`
+    semantics.
+
+    Rules are read from the directories under `base_dir` as they're
+    looked up and from the directories above it up to the top level of
+    its git repository, if it's in one (along with its `.git/info/exclude`).
+    Deeper files take precedence, as do later rules in the same file, and
+    `.repexignore` rules take precedence over `.gitignore` rules.
+    """
+    def __init__(self, base_dir, directory_index=None):
+        self.directory_index = directory_index or DirectoryIndex()
+        self.base_dir = os.path.abspath(base_dir)
+        self.top_dir = self._find_top_dir(self.base_dir)
+        self._rule_stacks = {}
+
+    @staticmethod
+    def _find_top_dir(base_dir):
+        directory = base_dir
+        while True:
+            if os.path.exists(os.path.join(directory, '.git')):
+                return directory
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return base_dir
+            directory = parent
+
+    def is_ignored(self, path, is_dir=False):
+        """Return whether `path` is ignored. A `.git` directory always is.
+        """
+        path = os.path.abspath(path)
+        if is_dir and os.path.basename(path) == '.git':
+            return True
+        ignored = False
+        for directory, rules in self._get_rule_stack(os.path.dirname(path)):
+            relative_path = os.path.relpath(path, directory).replace(
+                os.sep, '/')
+            for expression, negated, directory_only in rules:
+                if (is_dir or not directory_only) and \
+                        expression.match(relative_path):
+                    ignored = not negated
+        return ignored
+
+    def _get_rule_stack(self, directory):
+        """Return a list of the directories, from the top one down to
+        `directory`, which have rules, along with their rules.
+        """
+        if directory not in self._rule_stacks:
+            parent = os.path.dirname(directory)
+            if directory == self.top_dir or parent == directory or \
+                    not directory.startswith(self.top_dir):
+                rule_stack = []
+            else:
+                rule_stack = self._get_rule_stack(parent)
+            rules = self._read_rules(directory)
+            if rules:
+                rule_stack = rule_stack + [(directory, rules)]
+            self._rule_stacks[directory] = rule_stack
+        return self._rule_stacks[directory]
+
+    def _read_rules(self, directory):
+        try:
+            names = set(entry.name for entry in
+                        self.directory_index.scandir(directory))
+        except OSError:
+            return []
+        ignore_files = [os.path.join(directory, name)
+                        for name in IGNORE_FILE_NAMES if name in names]
+        if directory == self.top_dir:
+            ignore_files.insert(
+                0, os.path.join(directory, '.git', 'info', 'exclude'))
+        rules = []
+        for ignore_file in ignore_files:
+            try:
+                with open(ignore_file) as f:
+                    lines = f.readlines()
+            except (IOError, OSError):
+                continue
+            rules.extend(rule for rule in map(_ignore_pattern_to_regex, lines)
+                         if rule)
+        return rules
+
+
+def _walk(base_dir, descend, directory_index=None):
+    """Walk `base_dir` top-down, the same as `os.walk` does.
+
+    Yields a tuple of a directory and the `os.DirEntry` objects of all
+    non-directories in it. Sub-directories for which `descend` returns
+    False are pruned and are never listed. Like `os.walk`, symlinks to
+    directories are not followed and unreadable directories are skipped.
+    """
+    directory_index = directory_index or DirectoryIndex()
+    dirs_to_walk = [base_dir]
+    while dirs_to_walk:
+        root = dirs_to_walk.pop()
+        try:
+            entries = directory_index.scandir(root)
+        except OSError:
+            continue
+        files = []
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry)
+            elif not entry.is_symlink() and descend(entry.path):
+                subdirs.append(entry.path)
+        yield root, files
+        dirs_to_walk.extend(reversed(subdirs))
+
+
+class _CandidateEntry(object):
+    """A file to look at instead of an `os.DirEntry` found by walking
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _walk_candidates(base_dir, candidate_files, descend):
+    """Yield the same as `_walk` does, but only for `candidate_files`
+    instead of all files under `base_dir`.
+
+    Candidates which aren't under `base_dir`, or which are under
+    a directory for which `descend` returns False, are skipped.
+    """
+    absolute_base_dir = os.path.abspath(base_dir)
+    descended = {}
+    files_by_root = collections.OrderedDict()
+    for candidate_file in candidate_files:
+        relative_path = os.path.relpath(
+            os.path.abspath(candidate_file), absolute_base_dir)
+        if relative_path == os.pardir or \
+                relative_path.startswith(os.pardir + os.sep):
+            continue
+        relative_dir, filename = os.path.split(relative_path)
+        # Spell each directory the same as it would be when walking
+        root = base_dir
+        pruned = False
+        for directory in relative_dir.split(os.sep) if relative_dir else []:
+            root = os.path.join(root, directory)
+            if root not in descended:
+                descended[root] = descend(root)
+            pruned = pruned or not descended[root]
+        if not pruned:
+            files_by_root.setdefault(root, collections.OrderedDict())[
+                filename] = _CandidateEntry(os.path.join(root, filename))
+
+    for root, files in files_by_root.items():
+        yield root, list(files.values())
+
+
+def read_candidate_files(file_list):
+    """Return the paths listed in the `file_list` file object, one per
+    line, ignoring empty lines.
+    """
+    return [line.rstrip('\r\n') for line in file_list if line.strip()]
+
+
+def get_git_diff_files(revision=None):
+    """Return the absolute paths of the files which `git diff --name-only`
+    lists as changed compared to `revision` (or to the index if None).
+    """
+    try:
+        top_level = os.fsdecode(subprocess.check_output(
+            ['git', 'rev-parse', '--show-toplevel'])).rstrip('\n')
+        output = subprocess.check_output(
+            ['git', 'diff', '--name-only', '-z'] +
+            ([revision] if revision else []), cwd=top_level)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise RepexError('{0}: {1}'.format(ERRORS['git_diff_failed'], ex))
+    return [os.path.join(top_level, os.fsdecode(path))
+            for path in output.split(b'\0') if path]
+
+
 def get_all_files(filename_regex,
                   path,
                   base_dir,
                   excluded_paths=None,
-                  excluded_filename_regex=None):
+                  excluded_filename_regex=None,
+                  regexes=None,
+                  directory_index=None,
+                  candidate_files=None,
+                  stats=None,
+                  file_filter=None,
+                  gitignore=False,
+                  excluded_patterns=None):
     """Get all files for processing.
 
     This starts iterating from `base_dir` and checks for all files
     that look like `filename_regex` under `path` regex excluding
     all paths under the `excluded_paths` list, whether they are files
     or folders. `excluded_paths` are explicit paths, not regex.
+    `excluded_patterns` are `glob` patterns of paths relative to
+    `base_dir` (e.g. `*/build`) excluded the same way.
     `excluded_filename_regex` are files to be excluded as well.
+
+    Excluded directories are never walked. If `path` is anchored
+    (e.g. `^base/dir/sub`), neither are directories which can't lead
+    to it. Directories already listed in `directory_index` aren't
+    listed again.
+
+    If `candidate_files` is given, only those of them which are under
+    `base_dir` are looked at and `base_dir` isn't walked at all.
+
+    If a `FileFilter` is given, chosen files it skips (e.g. binaries)
+    aren't returned.
+
+    If `gitignore` is True, files and directories ignored by `.gitignore`
+    and `.repexignore` files are skipped. Ignored directories are never
+    walked.
+
+    The number of files looked at, and of those skipped by the filter,
+    is counted in `stats`, if given.
     """
     # For windows
     def replace_backslashes(string):
         return string.replace('\\', '/')
 
-    excluded_paths = _set_excluded_paths(base_dir, excluded_paths)
+    excluded_paths = ExcludedPaths(
+        base_dir, excluded_paths, excluded_patterns)
     if excluded_paths:
         logger.info('Excluded paths: %s', excluded_paths)
 
@@ -140,28 +1417,65 @@ def get_all_files(filename_regex,
     if excluded_filename_regex:
         logger.info('Excluding all files named: %s', excluded_filename_regex)
 
+    regexes = regexes or RegexRegistry()
     path = replace_backslashes(path)
-    path_expression = re.compile(path)
+    path_expression = regexes.compile(path)
+    filename_expression = regexes.compile(filename_regex)
+    excluded_filename_expression = regexes.compile(
+        excluded_filename_regex) if excluded_filename_regex else None
+    path_prefix = _get_anchored_prefix(path)
+    directory_index = directory_index or DirectoryIndex()
+    ignore_rules = IgnoreRules(base_dir, directory_index) \
+        if gitignore else None
+
+    def descend(dirpath):
+        if excluded_paths.is_excluded(dirpath):
+            return False
+        if ignore_rules and ignore_rules.is_ignored(dirpath, is_dir=True):
+            logger.debug('Skipping ignored directory %s...', dirpath)
+            return False
+        if path_prefix is None:
+            return True
+        dirpath = replace_backslashes(dirpath)
+        return dirpath.startswith(path_prefix) or \
+            path_prefix.startswith(dirpath)
 
     target_files = []
 
-    for root, _, files in os.walk(base_dir):
-        if not root.startswith(tuple(excluded_paths)) \
+    if candidate_files is None:
+        walked_files = _walk(base_dir, descend, directory_index)
+    else:
+        walked_files = _walk_candidates(base_dir, candidate_files, descend)
+    for root, files in walked_files:
+        if stats:
+            stats.add_walked(root, len(files))
+        if not excluded_paths.is_excluded(root) \
                 and path_expression.search(replace_backslashes(root)):
-            for filename in files:
-                filepath = os.path.join(root, filename)
+            for file_entry in files:
                 is_file, matched, excluded_filename, excluded_path = \
                     _set_match_parameters(
-                        filename,
-                        filepath,
-                        filename_regex,
-                        excluded_filename_regex,
+                        file_entry,
+                        filename_expression,
+                        excluded_filename_expression,
                         excluded_paths)
                 if is_file and matched and not excluded_filename \
                         and not excluded_path:
+                    if ignore_rules and \
+                            ignore_rules.is_ignored(file_entry.path):
+                        logger.debug('Skipping ignored file %s...',
+                                     file_entry.path)
+                        continue
+                    skip_reason = file_filter and \
+                        file_filter.get_skip_reason(file_entry)
+                    if skip_reason:
+                        logger.debug('Skipping %s by %s...',
+                                     file_entry.path, skip_reason)
+                        if stats:
+                            stats.count('files_skipped_' + skip_reason)
+                        continue
                     logger.debug('%s is a match. Appending to list...',
-                                 filepath)
-                    target_files.append(filepath)
+                                 file_entry.path)
+                    target_files.append(file_entry.path)
     return target_files
 
 
@@ -170,38 +1484,97 @@ class Validator(object):
         self.validation_type = validator_config.get('type', 'per_file')
         self.validator_path = validator_config.get('path')
         self.validation_function = validator_config.get('function')
+        self.pass_contents = validator_config.get('contents', False)
         self._validate_config()
+        self._function = None
 
     def validate(self, file_to_validate):
-        validator = self._import_validator()
-        if not hasattr(validator, self.validation_function):
-            raise RepexError(ERRORS['validator_function_not_found'])
+        validation_function = self._get_validation_function()
 
         logger.info('Validating %s using %s:%s...',
                     file_to_validate,
                     self.validator_path,
                     self.validation_function)
-        validated = getattr(validator, self.validation_function)(
-            file_to_validate, logger)
+        validated = validation_function(file_to_validate, logger)
         if validated:
             logger.info('Validation Succeeded for: %s', file_to_validate)
             return True
         else:
             return False
 
+    def validate_batch(self, written_files):
+        """Validate all files written for a path using a single call.
+
+        The validation function receives a list of the paths of the
+        written files and a logger. If `contents` is set in the config,
+        it also receives a dict of each path and its new content.
+        """
+        validation_function = self._get_validation_function()
+
+        file_paths = [written_file.path for written_file in written_files]
+        logger.info('Validating %s files using %s:%s...',
+                    len(file_paths),
+                    self.validator_path,
+                    self.validation_function)
+        if self.pass_contents:
+            contents = dict((written_file.path, written_file.content)
+                            for written_file in written_files)
+            for file_path, content in contents.items():
+                # Streamed files are never entirely in memory
+                if content is None:
+                    with open(file_path) as f:
+                        contents[file_path] = f.read()
+            validated = validation_function(file_paths, logger, contents)
+        else:
+            validated = validation_function(file_paths, logger)
+        if validated:
+            logger.info('Validation Succeeded for %s files', len(file_paths))
+            return True
+        else:
+            return False
+
     def _validate_config(self):
         if not os.path.isfile(self.validator_path):
             raise RepexError(ERRORS['validator_path_not_found'])
 
-    def _import_validator(self):
-        logger.debug('Importing validator: %s', self.validator_path)
-        return imp.load_source(
-            os.path.basename(self.validator_path), self.validator_path)
+    def _get_validation_function(self):
+        if not self._function:
+            validator = _import_validator(self.validator_path)
+            if not hasattr(validator, self.validation_function):
+                raise RepexError(ERRORS['validator_function_not_found'])
+            self._function = getattr(validator, self.validation_function)
+        return self._function
+
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+def _import_validator(validator_path):
+    """Import a validator script only once, no matter how many files
+    or paths it is used to validate.
+
+    The script is imported again only if it was modified since.
+    """
+    validator_path = os.path.abspath(validator_path)
+    key = (validator_path, os.path.getmtime(validator_path))
+    with _validators_lock:
+        if key not in _validators:
+            logger.debug('Importing validator: %s', validator_path)
+            loader = importlib.machinery.SourceFileLoader(
+                os.path.basename(validator_path), validator_path)
+            spec = importlib.util.spec_from_loader(loader.name, loader)
+            validator = importlib.util.module_from_spec(spec)
+            loader.exec_module(validator)
+            _validators[key] = validator
+        return _validators[key]
 
 
 class VariablesHandler(object):
     """Handle variable expansion and replacement
     """
+    def __init__(self, regexes=None):
+        self.regexes = regexes or RegexRegistry()
 
     def expand(self, repex_vars, attributes):
         r"""Receive a dict of variables and a dict of attributes
@@ -260,12 +1633,14 @@ class VariablesHandler(object):
         :param string in_string: the string to replace in
         """
         var_string = '{{ ' + '.{0}'.format(variable) + ' }}'
+        var_expression = self.regexes.compile(var_string)
 
-        if re.search(var_string, in_string):
+        if var_expression.search(in_string):
             logger.debug('Expanding var %s to %s in %s',
                          variable, value, in_string)
-            expanded_variable = re.sub(var_string, str(value), in_string)
-            if not self._check_if_expanded(var_string, expanded_variable):
+            expanded_variable = var_expression.sub(str(value), in_string)
+            if not self._check_if_expanded(
+                    var_expression, expanded_variable):
                 raise RepexError(ERRORS['string_failed_to_expand'])
             return expanded_variable
         return in_string
@@ -307,13 +1682,104 @@ def iterate(config_file_path=None,
             config=None,
             variables=None,
             tags=None,
-            validate=True):
+            validate=True,
+            workers=1,
+            regexes=None,
+            directory_index=None,
+            cache=None,
+            candidate_files=None,
+            dry_run=False,
+            stats=None):
     """Iterate over all paths in `config_file_path`
 
     :param string config_file_path: a path to a repex config file
     :param dict config: a dictionary representing a repex config
     :param dict variables: a dict of variables (can be None)
     :param list tags: a list of tags to check for
+    :param int workers: number of files to handle concurrently
+    :param RegexRegistry regexes: a registry of the regexes compiled
+     during the run (a new one is created if None)
+    :param DirectoryIndex directory_index: an index of the directories
+     listed during the run (a new one is created if None)
+    :param MatchCache cache: a cache of the files known to have nothing
+     to replace. It is saved once done (can be None)
+    :param list candidate_files: if given, only these files are handled
+     (if they're chosen by a path) and no directory is walked
+    :param bool dry_run: if True, nothing is written and validators
+     aren't run. A list of the `FileChange` of each file which would
+     have been written is returned instead.
+    :param RunStats stats: where the counters and timings of the run
+     are gathered (a new one is created if None)
+    """
+    stats = stats or RunStats()
+    file_buffer = FileBuffer(dry_run, stats)
+    for _ in _iter_results(config_file_path, config, variables, tags,
+                           validate, workers, regexes, directory_index,
+                           cache, candidate_files, file_buffer, stats):
+        pass
+    if dry_run:
+        return file_buffer.get_changes()
+
+
+def iter_results(config_file_path=None,
+                 config=None,
+                 variables=None,
+                 tags=None,
+                 validate=True,
+                 workers=1,
+                 regexes=None,
+                 directory_index=None,
+                 cache=None,
+                 candidate_files=None,
+                 dry_run=False,
+                 stats=None):
+    """Iterate over all paths in `config_file_path` the same as `iterate`
+    does, yielding a `FileResult` for each file as soon as it's handled.
+
+    Closing the generator stops the run. Files which were not handled
+    yet are then skipped while those already replaced in are written.
+    In a dry run, nothing is written and validators aren't run.
+    """
+    stats = stats or RunStats()
+    return _iter_results(config_file_path, config, variables, tags,
+                         validate, workers, regexes, directory_index,
+                         cache, candidate_files, FileBuffer(dry_run, stats),
+                         stats)
+
+
+def _iter_results(config_file_path,
+                  config,
+                  variables,
+                  tags,
+                  validate,
+                  workers,
+                  regexes,
+                  directory_index,
+                  cache,
+                  candidate_files,
+                  file_buffer,
+                  stats):
+    repex_paths, repex_vars, repex_tags = _get_run_config(
+        config_file_path, config, variables, tags, validate)
+    regexes = regexes or RegexRegistry()
+    directory_index = directory_index or DirectoryIndex()
+    repex_paths = list(_iter_tagged_paths(repex_paths, repex_tags))
+    prefilter = _get_prefilter(repex_paths, repex_vars, regexes)
+
+    try:
+        for path in repex_paths:
+            for result in iter_path_results(
+                    path, repex_vars, workers, regexes, directory_index,
+                    file_buffer, cache, candidate_files, stats, prefilter):
+                yield result
+    finally:
+        _finish_run(file_buffer, cache, workers)
+    logger.debug('Compiled %s regexes. Reused them %s times',
+                 regexes.misses, regexes.hits)
+
+
+def _get_run_config(config_file_path, config, variables, tags, validate):
+    """Return the paths, variables and tags of a run, once verified
     """
     # TODO: Check if tags can be a tuple instead of a list
     if not isinstance(variables or {}, dict):
@@ -333,60 +1799,211 @@ def iterate(config_file_path=None,
     repex_vars = _set_variables(vars_from_config, variables or {})
     repex_tags = tags or []
     logger.debug('Chosen tags: %s', repex_tags)
+    return repex_paths, repex_vars, repex_tags
+
 
+def _iter_tagged_paths(repex_paths, repex_tags):
     for path in repex_paths:
         path_tags = path.get('tags', [])
-        logger.debug('Checking chosen tags against path tags: %s', path_tags)
+        logger.debug('Checking chosen tags against path tags: %s',
+                     path_tags)
         tags_match = _check_for_matching_tags(repex_tags, path_tags)
         if tags_match:
             logger.debug('Matching tag(s) found for path: %s...', path)
-            handle_path(path, repex_vars)
+            yield path
         else:
-            logger.debug('No matching tags found for path: %s. Skipping...',
-                         path)
+            logger.debug(
+                'No matching tags found for path: %s. Skipping...', path)
 
 
-def handle_path(pathobj, variables=None):
+def _get_prefilter(repex_paths, repex_vars, regexes):
+    """Return a `LiteralPrefilter` of the paths of a run, unless there's
+    only one of them, which would then search each file on its own anyway.
+    """
+    if len(repex_paths) < 2:
+        return None
+    return LiteralPrefilter.from_paths(repex_paths, repex_vars, regexes)
+
+
+def _finish_run(file_buffer, cache, workers):
+    # Whatever was replaced until a failure is written, the same as
+    # if each path was written on its own
+    file_buffer.flush(workers)
+    if cache and not file_buffer.dry_run:
+        cache.save()
+
+
+def handle_path(pathobj,
+                variables=None,
+                workers=1,
+                regexes=None,
+                directory_index=None,
+                file_buffer=None,
+                cache=None,
+                candidate_files=None,
+                stats=None,
+                prefilter=None):
     """Iterate over all chosen files in a path
 
     :param dict pathobj: a dict of a specific path in the config
     :param dict variables: a dict of variables (can be None)
+    :param int workers: number of files to handle concurrently
+    :param RegexRegistry regexes: a registry of the regexes compiled
+     during the run (a new one is created if None)
+    :param DirectoryIndex directory_index: an index of the directories
+     listed during the run (can be None)
+    :param FileBuffer file_buffer: a buffer of the files replaced in
+     during the run but not yet written. If None, files are written
+     as soon as they're handled.
+    :param MatchCache cache: a cache of the files known to have nothing
+     to replace (can be None). It isn't saved.
+    :param list candidate_files: if given, only these files are handled
+     (if they're chosen by the path) and no directory is walked
+    :param RunStats stats: where the counters and timings of handling
+     the path are gathered (can be None)
+    :param LiteralPrefilter prefilter: the literals included in each
+     file, shared by all paths of a run (can be None)
+    """
+    for _ in iter_path_results(pathobj, variables, workers, regexes,
+                               directory_index, file_buffer, cache,
+                               candidate_files, stats, prefilter):
+        pass
+
+
+def iter_path_results(pathobj,
+                      variables=None,
+                      workers=1,
+                      regexes=None,
+                      directory_index=None,
+                      file_buffer=None,
+                      cache=None,
+                      candidate_files=None,
+                      stats=None,
+                      prefilter=None):
+    """Handle all chosen files in a path the same as `handle_path` does,
+    yielding a `FileResult` for each of them, in order, as soon as it's
+    handled. Closing the generator skips the files not handled yet.
+    """
+    files, handle_file, finish_path = _prepare_path(
+        pathobj, variables, workers, regexes, directory_index,
+        file_buffer, cache, candidate_files, stats, prefilter)
+    results = []
+    for result in _iter_handled_files(files, handle_file, workers):
+        results.append(result)
+        yield result
+    finish_path(files, results)
+
+
+def _prepare_path(pathobj,
+                  variables,
+                  workers,
+                  regexes,
+                  directory_index,
+                  file_buffer,
+                  cache,
+                  candidate_files,
+                  stats,
+                  prefilter):
+    """Return the files chosen by a path, a function which handles
+    each of them and a function which validates the path once all of
+    them were handled, receiving the files and what each of them wrote.
     """
     logger.info('Handling path with description: %s',
                 pathobj.get('description'))
 
+    regexes = regexes or RegexRegistry()
+    stats = stats or RunStats()
     variables = variables or {}
     if variables:
-        variable_expander = VariablesHandler()
-        pathobj = variable_expander.expand(variables, pathobj)
+        variable_expander = VariablesHandler(regexes)
+        with stats.timed('expand'):
+            pathobj = variable_expander.expand(variables, pathobj)
     pathobj['base_directory'] = pathobj.get('base_directory', os.getcwd())
     logger.debug('Path to process: %s', os.path.join(
         pathobj['base_directory'], pathobj['path']))
     path_to_handle = os.path.join(pathobj['base_directory'], pathobj['path'])
 
     validate = 'validator' in pathobj
+    dry_run = file_buffer is not None and file_buffer.dry_run
+    if validate and dry_run:
+        logger.info('Skipping validation in dry run')
+        validate = False
     if validate:
         validator_config = pathobj['validator']
         validator = Validator(validator_config)
         validator_type = validator_config.get('type', 'per_type')
+    # Only batch validators passed the contents of the files need them
+    keep_contents = validate and validator_type == 'batch' and \
+        validator.pass_contents
+
+    # Files written to another file, streamed or validated one by one
+    # must be read from and written to disk as they're handled
+    if file_buffer is not None and not dry_run and (
+            pathobj.get('to_file') or pathobj.get('stream') or
+            (validate and validator_type == 'per_file')):
+        file_buffer.flush(workers)
+        file_buffer = None
 
     rpx = Repex(
         pathobj['match'],
         pathobj['replace'],
         pathobj['with'],
         pathobj.get('to_file', False),
-        pathobj.get('must_include', [])
+        pathobj.get('must_include', []),
+        pathobj.get('stream', False),
+        regexes,
+        cache,
+        stats,
+        pathobj.get('literal', False),
+        prefilter
     )
 
     def verify_file_validation(file_to_validate):
-        if not validator.validate(file_to_validate):
-            raise RepexError(ERRORS['validation_failed'])
+        with stats.timed('validate'):
+            if not validator.validate(file_to_validate):
+                raise RepexError(ERRORS['validation_failed'])
+
+    def handle_file(file_to_handle):
+        result = rpx.handle_file(file_to_handle, file_buffer)
+        if file_buffer is not None:
+            file_buffer.release(file_to_handle)
+        if validate and validator_type == 'per_file':
+            verify_file_validation(file_to_handle)
+            result = result._replace(validated=True)
+        if result.written_file and not keep_contents:
+            result = result._replace(
+                written_file=result.written_file._replace(content=None))
+        stats.add_result(result)
+        # A new `to_file` must be found by paths handled later on
+        if rpx.to_file and result.written_file and directory_index:
+            directory_index.forget(
+                os.path.dirname(result.written_file.path))
+        return result
+
+    def finish_path(files, results):
+        # Validators read the files from disk
+        if validate and file_buffer is not None:
+            file_buffer.flush(workers)
+
+        if files and validate and validator_type == 'per_type':
+            verify_file_validation(files[-1])
+
+        written_files = [r.written_file for r in results if r.written_file]
+        if written_files and validate and validator_type == 'batch':
+            with stats.timed('validate'):
+                if not validator.validate_batch(written_files):
+                    raise RepexError(ERRORS['validation_failed'])
 
     if not pathobj.get('type'):
-        if os.path.isfile(path_to_handle):
-            rpx.handle_file(path_to_handle)
-            if validate:
-                verify_file_validation(path_to_handle)
+        if candidate_files is not None and os.path.abspath(path_to_handle) \
+                not in set(os.path.abspath(f) for f in candidate_files):
+            logger.info('%s is not a candidate file. Skipping...',
+                        path_to_handle)
+            files = []
+        # A `to_file` of a dry run only exists in the buffer
+        elif os.path.isfile(path_to_handle) or \
+                (dry_run and path_to_handle in file_buffer):
+            files = [path_to_handle]
         else:
             raise RepexError('{0}: {1}'.format(
                 ERRORS['file_not_found'], path_to_handle))
@@ -396,22 +2013,156 @@ def handle_path(pathobj, variables=None):
         if pathobj.get('to_file'):
             raise RepexError(ERRORS['to_file_requires_explicit_path'])
 
-        files = get_all_files(
-            pathobj['type'],
-            pathobj['path'],
-            pathobj['base_directory'],
-            pathobj.get('excluded', [])
-        )
-        for file_to_handle in files:
-            rpx.handle_file(file_to_handle)
-            if validate and validator_type == 'per_file':
-                verify_file_validation(file_to_handle)
-
-        # Need to check that `files` isn't an empty list or `file_to_handle`
-        # will be undefined.
-        if files and file_to_handle and validate and \
-                validator_type == 'per_type':
-            verify_file_validation(file_to_handle)
+        with stats.timed('walk'):
+            files = get_all_files(
+                pathobj['type'],
+                pathobj['path'],
+                pathobj['base_directory'],
+                pathobj.get('excluded', []),
+                regexes=regexes,
+                directory_index=directory_index,
+                candidate_files=candidate_files,
+                stats=stats,
+                file_filter=FileFilter.from_path(pathobj),
+                gitignore=pathobj.get('gitignore', False),
+                excluded_patterns=pathobj.get('excluded_patterns', [])
+            )
+    return files, handle_file, finish_path
+
+
+async def aiterate(config_file_path=None,
+                   config=None,
+                   variables=None,
+                   tags=None,
+                   validate=True,
+                   workers=1,
+                   regexes=None,
+                   directory_index=None,
+                   cache=None,
+                   candidate_files=None,
+                   dry_run=False,
+                   stats=None):
+    """Iterate over all paths in `config_file_path` the same as `iterate`
+    does, yielding a `FileResult` for each file once it's handled.
+
+    Config loading, file discovery, reading and writing are done in
+    a pool of `workers` threads so that the event loop is never blocked.
+    Closing the generator (e.g. once the task consuming it is cancelled)
+    stops the run. Files which were not handled yet are then skipped
+    while those already replaced in are written.
+    """
+    loop = asyncio.get_event_loop()
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        repex_paths, repex_vars, repex_tags = await loop.run_in_executor(
+            executor, _get_run_config,
+            config_file_path, config, variables, tags, validate)
+        regexes = regexes or RegexRegistry()
+        directory_index = directory_index or DirectoryIndex()
+        stats = stats or RunStats()
+        file_buffer = FileBuffer(dry_run, stats)
+        repex_paths = list(_iter_tagged_paths(repex_paths, repex_tags))
+        prefilter = _get_prefilter(repex_paths, repex_vars, regexes)
+        try:
+            for path in repex_paths:
+                results = _ahandle_path(
+                    executor, path, repex_vars, workers, regexes,
+                    directory_index, file_buffer, cache, candidate_files,
+                    stats, prefilter)
+                try:
+                    async for result in results:
+                        yield result
+                finally:
+                    await results.aclose()
+        finally:
+            await loop.run_in_executor(
+                executor, _finish_run, file_buffer, cache, workers)
+    finally:
+        executor.shutdown(wait=False)
+    logger.debug('Compiled %s regexes. Reused them %s times',
+                 regexes.misses, regexes.hits)
+
+
+async def ahandle_path(pathobj,
+                       variables=None,
+                       workers=1,
+                       regexes=None,
+                       directory_index=None,
+                       file_buffer=None,
+                       cache=None,
+                       candidate_files=None,
+                       stats=None,
+                       prefilter=None):
+    """Handle all chosen files in a path the same as `handle_path` does,
+    yielding a `FileResult` for each of them, in order, once handled.
+
+    Files are discovered and handled in a pool of `workers` threads,
+    with no more than `workers` files being handled at a time. Closing
+    the generator skips the files which were not handled yet.
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    results = _ahandle_path(
+        executor, pathobj, variables, workers, regexes, directory_index,
+        file_buffer, cache, candidate_files, stats, prefilter)
+    try:
+        async for result in results:
+            yield result
+    finally:
+        await results.aclose()
+        executor.shutdown(wait=False)
+
+
+async def _ahandle_path(executor,
+                        pathobj,
+                        variables,
+                        workers,
+                        regexes,
+                        directory_index,
+                        file_buffer,
+                        cache,
+                        candidate_files,
+                        stats,
+                        prefilter):
+    loop = asyncio.get_event_loop()
+    files, handle_file, finish_path = await loop.run_in_executor(
+        executor, _prepare_path, pathobj, variables, workers, regexes,
+        directory_index, file_buffer, cache, candidate_files, stats,
+        prefilter)
+
+    files_to_handle = collections.deque(files)
+    handled_files = collections.deque()
+    results = []
+    try:
+        while files_to_handle or handled_files:
+            while files_to_handle and len(handled_files) < workers:
+                handled_files.append(loop.run_in_executor(
+                    executor, handle_file, files_to_handle.popleft()))
+            result = await handled_files.popleft()
+            results.append(result)
+            yield result
+        await loop.run_in_executor(
+            executor, finish_path, files, results)
+    finally:
+        for handled_file in handled_files:
+            handled_file.cancel()
+
+
+# A file written by a path. `content` is None if the file was streamed
+# or if nothing needs its content, so it isn't kept around.
+WrittenFile = collections.namedtuple('WrittenFile', ['path', 'content'])
+
+# The content of a file before and after a dry run. `old_content` is None
+# if the file doesn't exist.
+FileChange = collections.namedtuple(
+    'FileChange', ['path', 'old_content', 'new_content'])
+
+# The result of handling a file: the number of matches found in it,
+# how many of them were replaced, the number of bytes written, how long
+# handling it took in seconds, whether it was validated (if validated on
+# its own) and its `WrittenFile` if it was (or is to be) written.
+FileResult = collections.namedtuple('FileResult', [
+    'path', 'matches', 'replacements', 'bytes_written', 'duration',
+    'validated', 'written_file'])
 
 
 class Repex(object):
@@ -420,106 +2171,518 @@ class Repex(object):
                  pattern_to_replace,
                  replace_with,
                  to_file=False,
-                 must_include=None):
+                 must_include=None,
+                 stream=False,
+                 regexes=None,
+                 cache=None,
+                 stats=None,
+                 literal=False,
+                 prefilter=None):
+        must_include = must_include or []
+        # Plain strings are escaped so that the rest only deals with regexes
+        escape = re.escape if literal else '{0}'.format
+        match_pattern = escape(match_regex)
+        must_include_patterns = [escape(string) for string in must_include]
+        if stream and any(_may_match_newline(pattern) for pattern
+                          in [match_pattern] + must_include_patterns):
+            raise RepexError(ERRORS['stream_multiline_regex'])
+
+        self.regexes = regexes = regexes or RegexRegistry()
+        self.literal = literal
         self.match_regex = match_regex
+        self.match_pattern = match_pattern
         self.pattern_to_replace = pattern_to_replace
-        self.match_expression = re.compile('(?P<matchgroup>{0})'.format(
-            match_regex))
-        self.replace_expression = re.compile(pattern_to_replace)
+        self.match_expression = regexes.compile('(?P<matchgroup>{0})'.format(
+            match_pattern))
+        self.replace_expression = regexes.compile(escape(pattern_to_replace))
+        # Matches of a literal are found and replaced using `str` methods
+        # and strings which don't include a required literal are skipped,
+        # instead of running the regex engine at all
+        self.literal_match = _get_literal(match_pattern) or None
+        self.required_literal = _get_required_literal(match_pattern)
+        # If so, no match can start before where it's first found
+        self.starts_with_required_literal = bool(self.required_literal) and \
+            _get_anchored_prefix('^' + match_pattern) == self.required_literal
 
         self.replace_with = replace_with
+        self._replace_template = \
+            replace_with.replace('\\', r'\\') if literal else replace_with
         self.to_file = to_file
-        self.must_include = must_include or []
+        self.must_include = must_include
+        self.must_include_expressions = [
+            regexes.compile(pattern) for pattern in must_include_patterns]
+        self._combined_must_include = self._combine_must_include(
+            self.must_include_expressions)
+        self._must_include_groups = dict(
+            (expression, 'must_include{0}'.format(index))
+            for index, expression in enumerate(self.must_include_expressions))
+        self.stream = stream
+        self._set_bytes_expressions()
+        self.cache = cache
+        self.prefilter = prefilter
+        self.stats = stats or RunStats()
+        self.rule_key = MatchCache.get_rule_key(
+            match_regex, pattern_to_replace, replace_with, to_file,
+            self.must_include, literal)
+
+    def _set_bytes_expressions(self):
+        """Set the bytes regexes used to reject files without reading
+        them, if that's possible for the configured regexes.
+        """
+        self.bytes_match_expression = None
+        self.bytes_required_literal = None
+        self.bytes_must_include = []
+        if not _is_text_encoding_utf8():
+            return
+        match_expression, _ = _to_bytes_regex(self.match_pattern)
+        must_include = [_to_bytes_regex(expression.pattern)
+                        for expression in self.must_include_expressions]
+        # Files missing required strings must still fail prevalidation,
+        # so these must match exactly to know that they don't.
+        if all(exact for _, exact in must_include):
+            self.bytes_match_expression = match_expression
+            if self.required_literal:
+                self.bytes_required_literal = \
+                    self.required_literal.encode('utf-8')
+            self.bytes_must_include = [e for e, _ in must_include]
+
+    def is_known_unmatched(self, file_to_handle):
+        """Return whether `file_to_handle` is certain to have no matches
+        and to include all required strings, without reading it.
+
+        The file is memory-mapped and searched using bytes regexes so that
+        its content is never copied or decoded. A file which doesn't
+        include the literal required by `match` isn't searched any further.
+        If a `LiteralPrefilter` was given, it's asked whether the file
+        includes that literal instead, if there are no required strings.
+        """
+        if not self.bytes_match_expression and \
+                not self.bytes_required_literal:
+            return False
+        if self.prefilter and self.bytes_required_literal and \
+                not self.bytes_must_include and \
+                not self.prefilter.may_include(
+                    file_to_handle, self.required_literal):
+            return True
+        with open(file_to_handle, 'rb') as f, self.stats.timed('match'):
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                content = b''
+            else:
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                unmatched = not self._may_match_bytes(content) and all(
+                    expression.search(content)
+                    for expression in self.bytes_must_include)
+            finally:
+                if content:
+                    content.close()
+        # Otherwise, the file is counted once it's read to be handled
+        if unmatched:
+            self.stats.count('bytes_read', size)
+        return unmatched
+
+    def _may_match_bytes(self, content):
+        position = 0
+        if self.bytes_required_literal:
+            position = content.find(self.bytes_required_literal)
+            if position == -1:
+                return False
+        if not self.bytes_match_expression:
+            return True
+        if not self.starts_with_required_literal:
+            position = 0
+        return bool(self.bytes_match_expression.search(content, position))
 
-    def handle_file(self, file_to_handle):
-        with open(file_to_handle) as f:
-            content = f.read()
+    def handle_file(self, file_to_handle, file_buffer=None):
+        """Replace all matches in `file_to_handle`.
 
-        if self.must_include and not \
-                self.validate_before(content, file_to_handle):
-            raise RepexError(ERRORS['prevalidation_failed'])
+        If a `FileBuffer` is given, the content is read from it and the
+        new content is kept in it instead of being written to the file.
+        It is then written once the buffer is flushed.
+
+        If a `MatchCache` was given, files it knows to have nothing to
+        replace are skipped and files found to have nothing to replace
+        are recorded in it.
+
+        Returns a `FileResult` of the file. Its `written_file` is
+        a `WrittenFile` of the output path and new content if the output
+        was (or is to be) written, or None otherwise.
+        """
+        started = time.time()
+        written_file, matches, replacements = self._handle_file_cached(
+            file_to_handle, file_buffer)
+        if not written_file:
+            bytes_written = 0
+        elif written_file.content is None:
+            bytes_written = os.path.getsize(written_file.path)
+        else:
+            bytes_written = len(written_file.content.encode(
+                locale.getpreferredencoding(False)))
+        return FileResult(
+            file_to_handle, matches, replacements, bytes_written,
+            time.time() - started, None, written_file)
+
+    def _handle_file_cached(self, file_to_handle, file_buffer):
+        buffered = file_buffer is not None and \
+            file_buffer.is_changed(file_to_handle)
+        # Only the file on disk can be looked up and recorded
+        if buffered or not self.cache:
+            return self._handle_file(file_to_handle, file_buffer, buffered)
+
+        signature = self.cache.get_signature(file_to_handle)
+        if self.cache.is_known_unmatched(
+                file_to_handle, self.rule_key, signature):
+            logger.debug('%s is cached as having nothing to replace. '
+                         'Skipping...', file_to_handle)
+            return None, 0, 0
+        handled = self._handle_file(file_to_handle, file_buffer)
+        if not handled[0]:
+            self.cache.add(file_to_handle, self.rule_key, signature)
+        return handled
+
+    def _handle_file(self, file_to_handle, file_buffer, buffered=False):
+        """Return the `WrittenFile` of `file_to_handle` (or None), the
+        number of matches found in it and the number of them replaced.
+        """
+        if not buffered and self.is_known_unmatched(file_to_handle):
+            self._log_replacing()
+            logger.info('Found 0 matches in %s', file_to_handle)
+            logger.info('Found nothing to replace within matches')
+            return None, 0, 0
+        if self.stream and file_buffer is None:
+            return self._handle_file_stream(file_to_handle)
 
-        replacements_found = False
-        output_file_path = self._init_file(file_to_handle)
-        matches = self.find_matches(content, file_to_handle)
+        if file_buffer is not None:
+            content = file_buffer.read(file_to_handle)
+        else:
+            with open(file_to_handle) as f, self.stats.timed('read'):
+                self.stats.count('bytes_read', os.fstat(f.fileno()).st_size)
+                content = f.read()
+
+        with self.stats.timed('match'):
+            if self.must_include and not \
+                    self.validate_before(content, file_to_handle):
+                raise RepexError(ERRORS['prevalidation_failed'])
+
+            self._log_replacing()
+            replacer = _MatchReplacer(self)
+            new_content = self.substitute(content, replacer)
+        counts = replacer.matches, replacer.replacements
+        logger.info('Found %s matches in %s', replacer.matches, file_to_handle)
+        if not replacer.replaced:
+            logger.info('Found nothing to replace within matches')
+        if not replacer.matches:
+            return (None,) + counts
+        if not self.to_file and new_content == content:
+            logger.debug('%s is unchanged. Nothing to write', file_to_handle)
+            return (None,) + counts
+        output_file_path = self.to_file or file_to_handle
+        if file_buffer is not None and \
+                (file_buffer.dry_run or not self.to_file):
+            file_buffer.write(output_file_path, new_content)
+            return (WrittenFile(output_file_path, new_content),) + counts
+        self._write_final_content(
+            new_content, output_file_path, file_to_handle)
+        return (WrittenFile(output_file_path, new_content),) + counts
+
+    def _log_replacing(self):
         logger.info(
             'Replacing all strings that match %s and are contained in '
             '%s with %s...', self.pattern_to_replace, self.match_regex,
             self.replace_with)
-        for match in matches:
-            if self.is_in_string(match):
-                replacements_found = True
-                content = self.replace(match, content)
-        if not replacements_found:
-            logger.info('Found nothing to replace within matches')
-        if matches:
-            self._write_final_content(content, output_file_path)
-        else:
-            os.remove(output_file_path + '.tmp')
 
     def validate_before(self, content, file_to_handle):
         """Verify that all required strings are in the file
         """
         logger.debug('Looking for required strings: %s', self.must_include)
-        included = True
-        for string in self.must_include:
-            if not re.search(r'{0}'.format(string), content):
-                logger.error('Required string `%s` not found in %s',
-                             string, file_to_handle)
-                included = False
-        if not included:
+        missing = self.find_missing_strings(
+            content, self.must_include_expressions)
+        for expression in missing:
+            logger.error('Required string `%s` not found in %s',
+                         expression.pattern, file_to_handle)
+        if missing:
             logger.debug('Required strings not found')
             return False
         logger.debug('Required strings found')
         return True
 
+    def find_missing_strings(self, content, expressions):
+        """Return those of the required string `expressions` which
+        are not found in `content`.
+
+        All of them are looked for in a single scan using a regex of all
+        required strings, compiled once, which stops as soon as all of
+        `expressions` are found.
+        """
+        missing = expressions
+        if not missing:
+            return missing
+        if not self._combined_must_include or any(
+                expression not in self._must_include_groups
+                for expression in missing):
+            return [e for e in missing if not e.search(content)]
+        for match in self._combined_must_include.finditer(content):
+            missing = [expression for expression in missing if match.group(
+                self._must_include_groups[expression]) is None]
+            if not missing:
+                break
+        return missing
+
+    def _combine_must_include(self, expressions):
+        """Return a regex which matches where any of `expressions` does,
+        without consuming anything, with a named group for each of them
+        which is set if it matched there. This way, all expressions
+        matching at the same position are found at once, even if they
+        overlap.
+
+        Returns None if there are no expressions or if they can't be
+        combined (e.g. due to numbered backreferences or conflicting
+        group names).
+        """
+        patterns = [expression.pattern for expression in expressions]
+        if not patterns or any(re.search(r'\\[1-9]|\(\?P=', pattern)
+                               for pattern in patterns):
+            return None
+        combined_pattern = '(?={0})'.format('|'.join(
+            '(?:{0})'.format(pattern) for pattern in patterns))
+        combined_pattern += ''.join(
+            '(?:(?=(?P<must_include{0}>{1}))|)'.format(index, pattern)
+            for index, pattern in enumerate(patterns))
+        try:
+            return self.regexes.compile(combined_pattern)
+        except re.error:
+            return None
+
     def find_matches(self, content, file_to_handle):
         """Find all matches of an expression in a file
         """
-        # look for all match groups in the content
-        groups = [match.groupdict() for match in
-                  self.match_expression.finditer(content)]
-        # filter out content not in the matchgroup
-        matches = [group['matchgroup'] for group in groups
-                   if group.get('matchgroup')]
+        matches = list(self._iter_matched_strings(content))
 
         logger.info('Found %s matches in %s', len(matches), file_to_handle)
         # We only need the unique strings found as we'll be replacing each
         # of them. No need to replace the ones already replaced.
         return list(set(matches))
 
+    def _iter_matched_strings(self, content):
+        """Yield each non-empty string matched in `content`
+        """
+        if self.literal_match:
+            for _ in range(content.count(self.literal_match)):
+                yield self.literal_match
+        elif not self.required_literal or self.required_literal in content:
+            # look for all match groups in the content
+            for match in self.match_expression.finditer(content):
+                # filter out content not in the matchgroup
+                if match.group('matchgroup'):
+                    yield match.group('matchgroup')
+
     def is_in_string(self, match):
         return True if self.replace_expression.search(match) else False
 
-    def replace(self, match, content):
+    def replace_in_match(self, matched_string):
+        """Return `matched_string` with `replace` replaced within it
+        """
+        return self.replace_expression.sub(
+            self._replace_template, matched_string)
+
+    def substitute(self, content, replacer):
+        """Return `content` with each match replaced by calling
+        `replacer` the same as `re.sub` does.
+
+        Matches of a literal `match` are counted and replaced using
+        `str.count` and `str.replace`. `content` which doesn't include
+        a literal required by `match` is returned as is.
+        """
+        if self.literal_match:
+            return replacer.replace_literal(content, self.literal_match)
+        if not self.required_literal:
+            return self.match_expression.sub(replacer, content)
+        position = content.find(self.required_literal)
+        if position == -1:
+            return content
+        if not self.starts_with_required_literal or not position:
+            return self.match_expression.sub(replacer, content)
+        return content[:position] + self.match_expression.sub(
+            replacer, content[position:])
+
+    def replace(self, content):
         """Replace all occurences of the regex in all matches
         from a file with a specific value.
+
+        This is done in a single pass over `content`, rewriting each match
+        in place as it is found. The replacement for each unique match is
+        only computed once.
+
+        Returns a tuple of the new content, the number of matches found
+        and whether anything within the matches was replaced.
         """
-        new_string = self.replace_expression.sub(self.replace_with, match)
-        logger.info('Replacing: [ %s ] --> [ %s ]', match, new_string)
-        new_content = self.match_expression.sub(new_string, content)
-        return new_content
+        replacer = _MatchReplacer(self)
+        new_content = self.substitute(content, replacer)
+        return new_content, replacer.matches, replacer.replaced
+
+    def _handle_file_stream(self, file_to_handle):
+        """Handle a file line by line without reading all of it at once.
 
-    def _init_file(self, file_to_handle):
-        temp_file_path = file_to_handle + '.tmp'
-        output_file_path = self.to_file if self.to_file else file_to_handle
-        if not self.to_file:
-            shutil.copy2(output_file_path, temp_file_path)
-        return output_file_path
+        The file is read once to verify that it includes all required
+        strings and that it should be written and then once more while
+        writing the replaced content straight to the output.
+        """
+        logger.debug('Looking for required strings: %s', self.must_include)
+        missing = self.must_include_expressions
+        matches = 0
+        write_needed = False
+        with open(file_to_handle) as f, self.stats.timed('match'):
+            self.stats.count('bytes_read', os.fstat(f.fileno()).st_size)
+            for line in f:
+                missing = self.find_missing_strings(line, missing)
+                if not write_needed:
+                    for matched_string in self._iter_matched_strings(line):
+                        matches += 1
+                        if self.to_file or self.replace_in_match(
+                                matched_string) != matched_string:
+                            write_needed = True
+                            break
+                if write_needed and not missing:
+                    break
+        if missing:
+            for expression in missing:
+                logger.error('Required string `%s` not found in %s',
+                             expression.pattern, file_to_handle)
+            raise RepexError(ERRORS['prevalidation_failed'])
 
-    def _write_final_content(self, content, output_file_path):
-        temp_file_path = output_file_path + '.tmp'
+        self._log_replacing()
+        if not write_needed:
+            if matches:
+                logger.debug('%s is unchanged. Nothing to write',
+                             file_to_handle)
+            else:
+                logger.info('Found 0 matches in %s', file_to_handle)
+            return None, matches, 0
+
+        replacer = _MatchReplacer(self)
+        output_file_path = self.to_file or file_to_handle
+        with open(file_to_handle) as f, self.stats.timed('write'):
+            with self._open_output(output_file_path, file_to_handle) as out:
+                for line in f:
+                    out.write(self.substitute(line, replacer))
+        logger.info('Found %s matches in %s', replacer.matches, file_to_handle)
+        if not replacer.replaced:
+            logger.info('Found nothing to replace within matches')
+        return (WrittenFile(output_file_path, None), replacer.matches,
+                replacer.replacements)
+
+    def _write_final_content(self,
+                             content,
+                             output_file_path,
+                             file_to_handle):
+        with self.stats.timed('write'):
+            with self._open_output(output_file_path,
+                                   file_to_handle) as output:
+                output.write(content)
+
+    def _open_output(self, output_file_path, file_to_handle):
         if self.to_file:
             logger.info('Writing output to %s...', output_file_path)
         else:
             logger.debug('Writing output to %s...', output_file_path)
-        with open(temp_file_path, "w") as temp_file:
-            temp_file.write(content)
+        return _open_output(output_file_path, file_to_handle, self.stats)
+
+
+@contextlib.contextmanager
+def _open_output(output_file_path, file_to_handle, stats=None):
+    """Open a file which atomically replaces `output_file_path`
+    once closed.
+
+    The content is written to a temporary file next to the output
+    which is then moved over it. When writing back to `file_to_handle`,
+    its attributes and owner are kept. Otherwise, only its mode is.
+    If `RunStats` are given, the write is counted in them.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_file_path))
+    fd, temp_file_path = tempfile.mkstemp(
+        prefix=os.path.basename(output_file_path) + '.',
+        suffix='.tmp',
+        dir=output_dir)
+    try:
+        # Attributes are copied before writing so that the modification
+        # time is updated
+        if output_file_path == file_to_handle:
+            _copy_file_attributes(file_to_handle, temp_file_path)
+        else:
+            shutil.copymode(file_to_handle, temp_file_path)
+        with os.fdopen(fd, 'w') as temp_file:
+            yield temp_file
+        bytes_written = os.path.getsize(temp_file_path)
+        shutil.move(temp_file_path, output_file_path)
+        if stats:
+            stats.add_written(bytes_written)
+    finally:
+        if os.path.isfile(temp_file_path):
+            os.remove(temp_file_path)
+
+
+class _MatchReplacer(object):
+    """A `re.sub` callback which replaces `replace_expression` within
+    each match of `match_expression` of a `Repex` instance.
+
+    The replacement of each unique match is only computed once. The same
+    instance can be used for multiple calls to `re.sub` (e.g. per line).
+    """
+    def __init__(self, rpx):
+        self.rpx = rpx
+        self.new_strings = {}
+        self.matches = 0
+        self.replacements = 0
+        self.replaced = False
+
+    def __call__(self, match):
+        matched_string = match.group('matchgroup')
+        if not matched_string:
+            return matched_string
+        self.matches += 1
+        new_string = self._get_new_string(matched_string)
+        if new_string != matched_string:
+            self.replacements += 1
+        return new_string
+
+    def replace_literal(self, content, literal):
+        """Replace all occurrences of a non-empty `literal` match in
+        `content` the same as `re.sub` would, counting them at once.
+        """
+        matches = content.count(literal)
+        if not matches:
+            return content
+        self.matches += matches
+        new_string = self._get_new_string(literal)
+        if new_string == literal:
+            return content
+        self.replacements += matches
+        return content.replace(literal, new_string)
+
+    def _get_new_string(self, matched_string):
+        if matched_string not in self.new_strings:
+            new_string = matched_string
+            if self.rpx.is_in_string(matched_string):
+                self.replaced = True
+                new_string = self.rpx.replace_in_match(matched_string)
+                logger.info('Replacing: [ %s ] --> [ %s ]',
+                            matched_string, new_string)
+            self.new_strings[matched_string] = new_string
+        return self.new_strings[matched_string]
+
+
+def _copy_file_attributes(source, destination):
+    """Copy the attributes of `source` to `destination` the same as
+    `shutil.copy2` does, along with its owner, if permitted.
+    """
+    shutil.copystat(source, destination)
+    if hasattr(os, 'chown'):
+        stat = os.stat(source)
         try:
-            shutil.move(temp_file_path, output_file_path)
-        finally:
-            if os.path.isfile(temp_file_path):
-                os.remove(temp_file_path)
+            os.chown(destination, stat.st_uid, stat.st_gid)
+        except OSError:
+            logger.debug('Could not keep the owner of %s', source)
 
 
 def _validate_config_schema(config):
@@ -537,6 +2700,9 @@ def _validate_config_schema(config):
                             'description': {'type': 'string'},
                             'path': {'type': 'string'},
                             'excluded': {'type': 'array'},
+                            'excluded_patterns': {
+                                'type': 'array',
+                                'items': {'type': 'string'}},
                             'base_directory': {'type': 'string'},
                             'match': {'type': 'string'},
                             'replace': {'type': 'string'},
@@ -544,12 +2710,23 @@ def _validate_config_schema(config):
                             'to_file': {'type': 'string'},
                             'must_include': {'type': 'array'},
                             'tags': {'type': 'array'},
+                            'stream': {'type': 'boolean'},
+                            'literal': {'type': 'boolean'},
+                            'min_size': {'type': 'integer', 'minimum': 0},
+                            'max_size': {'type': 'integer', 'minimum': 0},
+                            'skip_binary': {'type': 'boolean'},
+                            'gitignore': {'type': 'boolean'},
+                            'skipped_extensions': {
+                                'type': 'array',
+                                'items': {'type': 'string'}},
                             'validator': {
                                 'type': 'object',
                                 'properties': {
-                                    'type': {'enum': ['per_type', 'per_file']},
+                                    'type': {'enum': [
+                                        'per_type', 'per_file', 'batch']},
                                     'path': {'type': 'string'},
-                                    'function': {'type': 'string'}
+                                    'function': {'type': 'string'},
+                                    'contents': {'type': 'boolean'}
                                 },
                                 'required': ['path', 'function'],
                                 "additionalProperties": False
@@ -642,6 +2819,11 @@ CLICK_CONTEXT_SETTINGS = dict(
               multiple=True,
               help='Paths to exclude when searching for files to handle. '
                    'This can be used multiple times [non-config only]')
+@click.option('--exclude-pattern',
+              multiple=True,
+              help='Glob patterns (e.g. */build) of paths to exclude, '
+                   'relative to the basedir. '
+                   'This can be used multiple times [non-config only]')
 @click.option('-i',
               '--must-include',
               multiple=True,
@@ -652,15 +2834,48 @@ CLICK_CONTEXT_SETTINGS = dict(
                    '[non-config only]')
 @click.option('--validator-type',
               default='per_type',
-              type=click.Choice(['per_file', 'per_type']),
+              type=click.Choice(['per_file', 'per_type', 'batch']),
               help='Type of validation to perform. `per_type` will validate '
                    'the last file found while `per_file` will run validation '
-                   'for each file found. Defaults to `per_type` '
+                   'for each file found. `batch` will run validation once '
+                   'for all written files. Defaults to `per_type` '
                    '[non-config only]')
 @click.option('--to-file',
               cls=MutuallyExclusiveOption,
               mutually_exclusive=['ftype'],
               help='File path to write the output to [non-config only]')
+@click.option('--stream',
+              default=False,
+              is_flag=True,
+              help='Handle files line by line instead of reading them '
+                   'entirely. `match` and `must-include` must only match '
+                   'within a single line [non-config only]')
+@click.option('--literal',
+              default=False,
+              is_flag=True,
+              help='Treat `match`, `replace` and `must-include` as plain '
+                   'strings rather than regexes. `with` is then used as is '
+                   '[non-config only]')
+@click.option('--min-size',
+              type=click.IntRange(min=0),
+              help='Skip files smaller than this many bytes [non-config only]')
+@click.option('--max-size',
+              type=click.IntRange(min=0),
+              help='Skip files larger than this many bytes [non-config only]')
+@click.option('--skip-binary',
+              default=False,
+              is_flag=True,
+              help='Skip files which look binary (have a null byte in their '
+                   'first 8000 bytes) [non-config only]')
+@click.option('--skip-extension',
+              multiple=True,
+              help='Skip files with this extension (e.g. `png`). Can be used '
+                   'multiple times [non-config only]')
+@click.option('--gitignore',
+              default=False,
+              is_flag=True,
+              help='Skip files and directories ignored by `.gitignore` and '
+                   '`.repexignore` files [non-config only]')
 @click.option('-c',
               '--config',
               help='Path to a repex config file [config only]')
@@ -677,6 +2892,56 @@ CLICK_CONTEXT_SETTINGS = dict(
 @click.option('--validate/--no-validate',
               default=True,
               help='Validate the config (defaults to True) [config only]')
+@click.option('--files-from',
+              type=click.File('r'),
+              cls=MutuallyExclusiveOption,
+              mutually_exclusive=['git_diff'],
+              help='Only handle the files listed in this file, one per '
+                   'line, instead of walking directories. Use `-` to read '
+                   'the list from stdin')
+@click.option('--git-diff',
+              metavar='REVISION',
+              cls=MutuallyExclusiveOption,
+              mutually_exclusive=['files_from'],
+              help='Only handle the files listed by `git diff --name-only '
+                   'REVISION` (e.g. `HEAD` or `origin/master...`) instead '
+                   'of walking directories')
+@click.option('--dry-run',
+              default=False,
+              is_flag=True,
+              help='Do not write anything. Print a summary of the files '
+                   'which would be written instead')
+@click.option('--diff',
+              default=False,
+              is_flag=True,
+              help='Do not write anything. Print a unified diff of the '
+                   'files which would be written instead')
+@click.option('--cache-dir',
+              help='A directory in which to keep a cache of the files '
+                   'known to have nothing to replace, so that they are '
+                   'skipped in later runs until modified')
+@click.option('--stats',
+              'show_stats',
+              default=False,
+              is_flag=True,
+              help='Print the time spent in each phase of the run, '
+                   'how many files and bytes were handled and the '
+                   'slowest files once done')
+@click.option('--stats-file',
+              help='Write a JSON report of the time spent in each phase '
+                   'of the run, its counters and slowest files to this '
+                   'file once done')
+@click.option('--profile',
+              metavar='PATH',
+              help='Profile the run, write the profile to this file in '
+                   'pstats format and print the functions most time was '
+                   'spent in once done. With more than one job, only the '
+                   'main thread is profiled')
+@click.option('-j',
+              '--jobs',
+              default=1,
+              type=click.IntRange(min=1),
+              help='Number of files to handle concurrently. Defaults to 1')
 @click.option('-v',
               '--verbose',
               default=False,
@@ -689,15 +2954,32 @@ def main(ftype,
          replace,
          replace_with,
          exclude_paths,
+         exclude_pattern,
          must_include,
          validator,
          validator_type,
          to_file,
+         stream,
+         literal,
+         min_size,
+         max_size,
+         skip_binary,
+         skip_extension,
+         gitignore,
          config,
          vars_file,
          var,
          tag,
          validate,
+         files_from,
+         git_diff,
+         dry_run,
+         diff,
+         cache_dir,
+         show_stats,
+         stats_file,
+         profile,
+         jobs,
          verbose):
     """Replace strings in one or multiple files.
 
@@ -718,42 +3000,131 @@ def main(ftype,
         click.echo('Must either provide a path or a viable repex config file.')
         sys.exit(1)
 
-    if config:
-        repex_vars = _build_vars_dict(vars_file, var)
-        try:
-            iterate(
-                config_file_path=config,
-                variables=repex_vars,
-                tags=list(tag),
-                validate=validate)
-        except (RepexError, IOError) as ex:
-            sys.exit(str(ex))
-    else:
-        regex_to_replace = r'{0}'.format(replace)
-        regex_path = r'{0}'.format(regex_path)
-        # TODO: change ftype argument name
-        regex_filename = r'{0}'.format(ftype) if ftype else None
-        regex_to_match = r'{0}'.format(match) if match else replace
-
-        pathobj = {
-            'type': regex_filename,
-            'path': regex_path,
-            'to_file': to_file,
-            'base_directory': basedir,
-            'match': regex_to_match,
-            'replace': regex_to_replace,
-            'with': replace_with,
-            'excluded': list(exclude_paths),
-            'must_include': list(must_include)
-        }
-        if validator:
-            validator_path, validator_function = validator.split(':')
-            pathobj['validator'] = {
-                'type': validator_type,
-                'path': validator_path,
-                'function': validator_function
+    cache = MatchCache(cache_dir) if cache_dir else None
+    stats = RunStats()
+    dry_run = dry_run or diff
+    candidate_files = None
+    try:
+        if files_from:
+            candidate_files = read_candidate_files(files_from)
+        elif git_diff:
+            candidate_files = get_git_diff_files(git_diff)
+    except RepexError as ex:
+        sys.exit(str(ex))
+
+    # A dry run's changes or diff are printed to stdout on their own
+    with _profiled(profile), _logging_to_stderr(dry_run):
+        if config:
+            repex_vars = _build_vars_dict(vars_file, var)
+            try:
+                changes = iterate(
+                    config_file_path=config,
+                    variables=repex_vars,
+                    tags=list(tag),
+                    validate=validate,
+                    workers=jobs,
+                    cache=cache,
+                    candidate_files=candidate_files,
+                    dry_run=dry_run,
+                    stats=stats)
+            except (RepexError, IOError) as ex:
+                sys.exit(str(ex))
+        else:
+            regex_to_replace = r'{0}'.format(replace)
+            regex_path = r'{0}'.format(regex_path)
+            # TODO: change ftype argument name
+            regex_filename = r'{0}'.format(ftype) if ftype else None
+            regex_to_match = r'{0}'.format(match) if match else replace
+
+            pathobj = {
+                'type': regex_filename,
+                'path': regex_path,
+                'to_file': to_file,
+                'base_directory': basedir,
+                'match': regex_to_match,
+                'replace': regex_to_replace,
+                'with': replace_with,
+                'excluded': list(exclude_paths),
+                'excluded_patterns': list(exclude_pattern),
+                'must_include': list(must_include),
+                'stream': stream,
+                'literal': literal,
+                'min_size': min_size,
+                'max_size': max_size,
+                'skip_binary': skip_binary,
+                'skipped_extensions': list(skip_extension),
+                'gitignore': gitignore
             }
-        try:
-            handle_path(pathobj)
-        except (RepexError, IOError) as ex:
-            sys.exit(str(ex))
+            if validator:
+                validator_path, validator_function = validator.split(':')
+                pathobj['validator'] = {
+                    'type': validator_type,
+                    'path': validator_path,
+                    'function': validator_function
+                }
+            file_buffer = FileBuffer(True, stats) if dry_run else None
+            try:
+                handle_path(pathobj,
+                            workers=jobs,
+                            file_buffer=file_buffer,
+                            cache=cache,
+                            candidate_files=candidate_files,
+                            stats=stats)
+                if cache and not dry_run:
+                    cache.save()
+            except (RepexError, IOError) as ex:
+                sys.exit(str(ex))
+            changes = file_buffer.get_changes() if dry_run else None
+
+    if dry_run:
+        _echo_changes(changes, diff)
+    if show_stats:
+        click.echo(stats.get_summary())
+    if stats_file:
+        with open(stats_file, 'w') as f:
+            json.dump(stats.get_report(), f, indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def _profiled(profile_path, top_functions=20):
+    """Profile the block, even if it exits, write the profile to
+    `profile_path` and print the functions most time was spent in.
+    Does nothing if `profile_path` is None.
+    """
+    if not profile_path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        click.echo('Wrote profile to {0}'.format(profile_path))
+        profile_stats = pstats.Stats(profiler, stream=sys.stdout)
+        profile_stats.sort_stats('cumulative').print_stats(top_functions)
+
+
+def _echo_changes(changes, diff=False):
+    """Print a unified diff of each of the `changes` of a dry run
+    or a summary of the lines changed in each file.
+    """
+    for change in changes:
+        if diff:
+            click.echo(get_diff(change), nl=False)
+            continue
+        added = removed = 0
+        matcher = difflib.SequenceMatcher(
+            None,
+            (change.old_content or '').splitlines(),
+            change.new_content.splitlines(),
+            autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                removed += i2 - i1
+                added += j2 - j1
+        click.echo('Would write {0} (+{1} -{2} lines)'.format(
+            change.path, added, removed))
+    if not diff:
+        click.echo('{0} files would be written'.format(len(changes)))
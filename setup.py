@@ -21,6 +21,7 @@ setup(
     description='sed on steroids',
     long_description=read('README.rst'),
     py_modules=['repex'],
+    python_requires='>=3.6',
     entry_points={'console_scripts': ['rpx = repex:main']},
     install_requires=[
         "click==6.7",
@@ -30,12 +31,8 @@ setup(
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.6',
         'Natural Language :: English',
         'Environment :: Console',
@@ -5,3 +5,14 @@ def succeed_validate(file_path, logger):
 
 def fail_validate(file_path, logger):
     return False
+
+
+def succeed_batch_validate(file_paths, logger, contents=None):
+    if contents is not None:
+        return sorted(contents) == sorted(file_paths) and \
+            all('3.1.0-m3' in content for content in contents.values())
+    return all(file_path.endswith('mock_VERSION') for file_path in file_paths)
+
+
+def fail_batch_validate(file_paths, logger, contents=None):
+    return False
@@ -14,7 +14,14 @@
 #    * limitations under the License.
 
 import os
+import sys
+import re
+import json
+import pstats
+import time
 import shlex
+import asyncio
+import subprocess
 import tempfile
 
 import pytest
@@ -50,6 +57,36 @@ def _invoke(params=None):
     return rpx.invoke(getattr(repex, 'main'), params)
 
 
+VERSION_CONTENT = '"date": "x"\n"version": "3.1.0-m2"\n'
+
+
+def _create_version_files(base_dir, count=3, content=VERSION_CONTENT):
+    """Create a `TEST_FILE_NAME` file of `content` in each of `count`
+    new directories under `base_dir` and return their paths
+    """
+    files = []
+    for index in range(count):
+        version_file = base_dir.mkdir('dir{0}'.format(index)).join(
+            TEST_FILE_NAME)
+        version_file.write(content)
+        files.append(str(version_file))
+    return files
+
+
+def _version_path_object(base_dir, **kwargs):
+    """Return a path replacing the version of all `TEST_FILE_NAME` files
+    under `base_dir`, updated with `kwargs`
+    """
+    return dict({
+        'type': TEST_FILE_NAME,
+        'path': '.',
+        'base_directory': str(base_dir),
+        'match': '"version": "3.1.0-m2"',
+        'replace': '3.1.0-m2',
+        'with': '3.1.0-m3',
+    }, **kwargs)
+
+
 class TestBase:
     def test_invoke_main(self):
         result = _invoke()
@@ -275,6 +312,882 @@ class TestMultipleFiles:
         _test('multiple', params, '3.1.0-m2', '3.1.0-m2')
 
 
+def _legacy_replace(rpx, content):
+    """The multi-pass replacement `Repex.handle_file` used to perform.
+
+    Kept here to verify that the single-pass engine produces identical
+    output.
+    """
+    for match in rpx.find_matches(content, 'legacy'):
+        if rpx.is_in_string(match):
+            new_string = rpx.replace_expression.sub(rpx.replace_with, match)
+            content = rpx.match_expression.sub(new_string, content)
+    return content
+
+
+class TestReplace():
+
+    def _test_identical_to_legacy(self, match, replace, replace_with,
+                                  content):
+        rpx = repex.Repex(match, replace, replace_with)
+        new_content, _, _ = rpx.replace(content)
+        assert new_content == _legacy_replace(rpx, content)
+        return new_content
+
+    def test_replace_single_match(self):
+        new_content = self._test_identical_to_legacy(
+            '"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m3',
+            '{\n  "version": "3.1.0-m2",\n  "date": "x"\n}\n')
+        assert '"version": "3.1.0-m3"' in new_content
+
+    def test_replace_repeated_match(self):
+        content = 'version: 1.0.0\nother: 1.0.0\n' * 50
+        new_content = self._test_identical_to_legacy(
+            'version: 1.0.0', '1.0.0', '1.1.0', content)
+        assert new_content.count('version: 1.1.0') == 50
+        assert new_content.count('other: 1.0.0') == 50
+
+    def test_replace_distinct_matches_same_replacement(self):
+        content = 'a=1.0\nb=2.0\nc=3.0\nd=2.0\n'
+        new_content = self._test_identical_to_legacy(
+            r'=\d+\.\d+', r'\d+\.\d+', '4.0', content)
+        assert new_content == 'a=4.0\nb=4.0\nc=4.0\nd=4.0\n'
+
+    def test_replace_match_without_replace_pattern(self):
+        content = 'version: 1.0.0\n'
+        rpx = repex.Repex('version', '1.0.0', '2.0.0')
+        new_content, matches, replaced = rpx.replace(content)
+        assert new_content == _legacy_replace(rpx, content) == content
+        assert matches == 1
+        assert not replaced
+
+    def test_replace_no_matches(self):
+        content = 'nothing to see here\n'
+        rpx = repex.Repex('version', 'version', 'x')
+        new_content, matches, replaced = rpx.replace(content)
+        assert new_content == _legacy_replace(rpx, content) == content
+        assert matches == 0
+        assert not replaced
+
+    def test_replace_unicode_content(self):
+        content = u'\u05e9\u05dc\u05d5\u05dd version: 1.0 \u2713\n' * 3
+        self._test_identical_to_legacy('version: 1.0', '1.0', '2.0', content)
+
+    def test_replace_distinct_matches_keep_their_context(self):
+        content = '"a": "1"\n"b": "1"\n'
+        rpx = repex.Repex('"(a|b)": "1"', '1', '2')
+        new_content, matches, replaced = rpx.replace(content)
+        assert new_content == '"a": "2"\n"b": "2"\n'
+        assert matches == 2
+        assert replaced
+
+    def test_handle_file_identical_to_legacy(self):
+        with open(MOCK_TEST_FILE) as f:
+            content = f.read()
+        fd, tmp = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            rpx = repex.Repex(
+                r'"version": "\d+\.\d+(\.\d+)?(-\w\d+)?"',
+                r'\d+\.\d+(\.\d+)?(-\w\d+)?',
+                '3.1.0-m3',
+                to_file=tmp)
+            rpx.handle_file(MOCK_TEST_FILE)
+            with open(tmp) as f:
+                assert f.read() == _legacy_replace(rpx, content)
+        finally:
+            os.remove(tmp)
+
+
+class TestWriteFile():
+
+    def _create_file(self, tmpdir, content='"version": "3.1.0-m2"\n'):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write(content)
+        return str(version_file)
+
+    def _handle_file(self, path, match, replace, replace_with, to_file=False):
+        stat = os.stat(path)
+        repex.Repex(match, replace, replace_with, to_file).handle_file(path)
+        assert sorted(os.listdir(os.path.dirname(path))) == \
+            sorted(os.path.basename(p) for p in (path, to_file) if p)
+        return stat, os.stat(path)
+
+    def test_no_matches_not_written(self, tmpdir):
+        path = self._create_file(tmpdir)
+        before, after = self._handle_file(path, 'build', 'build', 'x')
+        assert before.st_ino == after.st_ino
+        assert before.st_mtime == after.st_mtime
+
+    def test_unchanged_content_not_written(self, tmpdir):
+        path = self._create_file(tmpdir)
+        before, after = self._handle_file(
+            path, '"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m2')
+        assert before.st_ino == after.st_ino
+        assert before.st_mtime == after.st_mtime
+
+    def test_changed_content_keeps_attributes(self, tmpdir):
+        path = self._create_file(tmpdir)
+        os.chmod(path, 0o640)
+        os.utime(path, (1000000000, 1000000000))
+        before, after = self._handle_file(
+            path, '"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m3')
+        with open(path) as f:
+            assert f.read() == '"version": "3.1.0-m3"\n'
+        assert before.st_mode == after.st_mode
+        assert before.st_uid == after.st_uid
+        assert before.st_mtime != after.st_mtime
+
+    def test_to_file_no_matches_not_written(self, tmpdir):
+        path = self._create_file(tmpdir)
+        to_file = str(tmpdir.join('VERSION.test'))
+        repex.Repex('build', 'build', 'x', to_file).handle_file(path)
+        assert os.listdir(str(tmpdir)) == [TEST_FILE_NAME]
+
+    def test_to_file_unchanged_content_written(self, tmpdir):
+        path = self._create_file(tmpdir)
+        to_file = str(tmpdir.join('VERSION.test'))
+        self._handle_file(
+            path, '"version": "3.1.0-m2"', '3.1.0-m2', '3.1.0-m2', to_file)
+        with open(to_file) as f:
+            assert f.read() == '"version": "3.1.0-m2"\n'
+
+
+class TestStream():
+
+    CONTENT = ''.join(
+        '{{"name": "n{0}", "version": "3.1.0-m{1}", "date": ""}}\n'.format(
+            index, index % 3) for index in range(100))
+
+    def _create_file(self, tmpdir, name, content=CONTENT):
+        path = tmpdir.join(name)
+        path.write(content)
+        return str(path)
+
+    def _test_identical_to_non_stream(self, tmpdir, match, replace,
+                                      replace_with, must_include=None):
+        streamed = self._create_file(tmpdir, 'streamed')
+        read = self._create_file(tmpdir, 'read')
+        repex.Repex(match, replace, replace_with,
+                    must_include=must_include,
+                    stream=True).handle_file(streamed)
+        repex.Repex(match, replace, replace_with,
+                    must_include=must_include).handle_file(read)
+        with open(streamed) as s, open(read) as r:
+            streamed_content = s.read()
+            assert streamed_content == r.read()
+        return streamed_content
+
+    def test_stream_identical_to_non_stream(self, tmpdir):
+        content = self._test_identical_to_non_stream(
+            tmpdir, r'"version": "\d+\.\d+\.\d+-m[12]"', r'-m\d', '-m9',
+            must_include=['date', r'n\d+'])
+        assert content.count('3.1.0-m9') == 66
+        assert content.count('3.1.0-m0') == 34
+
+    def test_stream_identical_to_non_stream_no_matches(self, tmpdir):
+        content = self._test_identical_to_non_stream(
+            tmpdir, 'build', 'build', 'x')
+        assert content == self.CONTENT
+
+    def test_stream_must_include_missing(self, tmpdir):
+        path = self._create_file(tmpdir, 'streamed')
+        rpx = repex.Repex('version', 'version', 'x',
+                          must_include=['date', 'MISSING_INCLUSION'],
+                          stream=True)
+        with pytest.raises(repex.RepexError) as ex:
+            rpx.handle_file(path)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex)
+        with open(path) as f:
+            assert f.read() == self.CONTENT
+
+    def test_stream_to_file(self, tmpdir):
+        path = self._create_file(tmpdir, 'streamed')
+        to_file = str(tmpdir.join('VERSION.test'))
+        rpx = repex.Repex('3.1.0-m2', 'm2', 'm2', to_file, stream=True)
+        rpx.handle_file(path)
+        with open(to_file) as f:
+            assert f.read() == self.CONTENT
+
+    def test_stream_multiline_regex(self):
+        for match, must_include in (
+                (r'version\s', []),
+                ('^version', []),
+                ('[^"]+', []),
+                ('(?s)version.', []),
+                ('version', [r'date\n'])):
+            with pytest.raises(repex.RepexError) as ex:
+                repex.Repex(match, 'x', 'y', must_include=must_include,
+                            stream=True)
+            assert repex.ERRORS['stream_multiline_regex'] in str(ex)
+
+    def test_stream_handle_path(self, tmpdir):
+        path = self._create_file(tmpdir, TEST_FILE_NAME)
+        repex.handle_path({
+            'path': path,
+            'match': '"version": "3.1.0-m0"',
+            'replace': 'm0',
+            'with': 'm3',
+            'stream': True,
+        })
+        with open(path) as f:
+            assert f.read() == self.CONTENT.replace('m0', 'm3')
+
+
+class TestBytesPrefilter():
+
+    PATTERNS = [
+        r'"version": "\d+\.\d+(\.\d+)?(-\w\d+)?"',
+        'date',
+        'a.b',
+        '[^"]+x',
+        r'\bword\b',
+        r'(?P<v>\d)(?P=v)',
+        u'\xe9+',
+        r'a\nb$',
+        '[0-9]{2}',
+    ]
+    CONTENTS = [
+        u'"version": "3.1.0-m2"',
+        u'"version": "\u0663.\u0661"',
+        u'date',
+        u'a\xe9b',
+        u'a\r\nb',
+        u'a\r\nb\r\n',
+        u'"\xe9\xe9x',
+        u'\xe9word\xe9',
+        u'\u0661\u0661',
+        u'\xe9\xe9\xe9',
+        u'42',
+        u'',
+    ]
+
+    def test_to_bytes_regex_matches_at_least_where_regex_does(self):
+        for pattern in self.PATTERNS:
+            bytes_expression, exact = repex._to_bytes_regex(pattern)
+            assert bytes_expression
+            for content in self.CONTENTS:
+                # What a file opened in text mode would read
+                decoded = content.replace(u'\r\n', u'\n')
+                matched = bool(re.search(pattern, decoded))
+                bytes_matched = bool(
+                    bytes_expression.search(content.encode('utf-8')))
+                if matched:
+                    assert bytes_matched, (pattern, content)
+                if exact:
+                    assert matched == bytes_matched, (pattern, content)
+
+    def test_to_bytes_regex_not_translatable(self):
+        for pattern in ('(?=x)', '(?i)x', r'[\w.]', u'[\xe9]', r'\u00e9'):
+            assert repex._to_bytes_regex(pattern) == (None, False)
+
+    def _create_file(self, tmpdir, content):
+        path = tmpdir.join(TEST_FILE_NAME)
+        path.write_binary(content.encode('utf-8'))
+        return str(path)
+
+    def _record_open_modes(self, monkeypatch):
+        modes = []
+
+        def recording_open(path, mode='r', *args, **kwargs):
+            modes.append(mode)
+            return open(path, mode, *args, **kwargs)
+
+        monkeypatch.setattr(repex, 'open', recording_open, raising=False)
+        return modes
+
+    def test_unmatched_file_not_read(self, tmpdir, monkeypatch):
+        path = self._create_file(tmpdir, u'"date": "",\n"build": "8"\n')
+        modes = self._record_open_modes(monkeypatch)
+        rpx = repex.Repex(r'"version": "\d+"', r'\d+', '9',
+                          must_include=['date'])
+        rpx.handle_file(path)
+        assert modes == ['rb']
+
+    def test_matched_file_read(self, tmpdir, monkeypatch):
+        path = self._create_file(tmpdir, u'"date": "",\n"version": "8"\n')
+        modes = self._record_open_modes(monkeypatch)
+        rpx = repex.Repex(r'"version": "\d+"', r'\d+', '9',
+                          must_include=['date'])
+        rpx.handle_file(path)
+        assert modes == ['rb', 'r']
+        with open(path) as f:
+            assert '"version": "9"' in f.read()
+
+    def test_unmatched_file_must_include_missing(self, tmpdir):
+        path = self._create_file(tmpdir, u'"build": "8"\n')
+        rpx = repex.Repex('version', 'version', 'x', must_include=['date'])
+        assert not rpx.is_known_unmatched(path)
+        with pytest.raises(repex.RepexError) as ex:
+            rpx.handle_file(path)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex)
+
+    def test_inexact_must_include_not_prefiltered(self, tmpdir):
+        path = self._create_file(tmpdir, u'"build": "8"\n')
+        rpx = repex.Repex('version', 'version', 'x', must_include=[r'\d'])
+        assert not rpx.is_known_unmatched(path)
+
+    def test_empty_file(self, tmpdir):
+        path = self._create_file(tmpdir, u'')
+        assert repex.Repex('version', 'version', 'x').is_known_unmatched(path)
+
+
+class TestLiteral():
+
+    PATTERNS = [
+        '"version": "3.1.0-m2"',
+        r'"version": "\d+\.\d+"',
+        'ab*cd',
+        'x{2,3}yz',
+        'a{b',
+        'abc(def)?gh',
+        'a(?:bcd)+e',
+        '[ab]cdef',
+        '^ver',
+        'ab*?cd',
+        r'3\.1\.0',
+        r'[\]x]yz',
+        r'(ab){2}c',
+        r'(ab){x}c',
+    ]
+    CONTENTS = [
+        '"version": "3.1.0-m2"',
+        '"version": "31.42"',
+        'acd',
+        'xxyz',
+        'a{b',
+        'abcgh',
+        'abcdbcde',
+        'bcdef',
+        'version',
+        '3.1.0',
+        ']yz',
+        'c\n{.1',
+        'ababc',
+        'ab{x}c',
+    ]
+
+    def test_required_literal(self):
+        for pattern in self.PATTERNS:
+            literal = repex._get_required_literal(pattern)
+            assert literal
+            for content in self.CONTENTS:
+                if re.search(pattern, content):
+                    assert literal in content, (pattern, content)
+
+    def test_optional_group_with_literal_brace(self):
+        pattern = r'(-\w*?(?P<g>.*){*)?b*'
+        assert re.search(pattern, 'c\n{.1')
+        assert repex._get_required_literal(pattern) is None
+
+    def test_no_required_literal(self):
+        for pattern in ('a|b', '(?i)abc', 'abc(?!de)', r'[\w]', '.*'):
+            assert repex._get_required_literal(pattern) is None
+
+    def test_get_literal(self):
+        assert repex._get_literal(r'3\.1\.0-m2 "x"') == '3.1.0-m2 "x"'
+        for pattern in ('3.1.0', r'\d', 'a+', '(a)', r'\n'):
+            assert repex._get_literal(pattern) is None
+
+    def test_literal_match_same_as_regex(self):
+        content = 'a 3.1.0-m2 3.1.0-m2 3x1x0-m2 3.1.0-m23.1.0-m2\n'
+        rpx = repex.Repex(r'3\.1\.0-m2', 'm2', 'm3')
+        assert rpx.literal_match == '3.1.0-m2'
+        regex_rpx = repex.Repex(r'3\.1\.0-m[2]', 'm2', 'm3')
+        assert regex_rpx.literal_match is None
+        assert rpx.replace(content) == regex_rpx.replace(content) == (
+            'a 3.1.0-m3 3.1.0-m3 3x1x0-m2 3.1.0-m33.1.0-m3\n', 4, True)
+        assert rpx.find_matches(content, 'file') == ['3.1.0-m2']
+        assert rpx.replace('a 3.1.0') == ('a 3.1.0', 0, False)
+
+    def test_literal(self, tmpdir):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write('a.b axb a.b\n')
+        rpx = repex.Repex('a.b', '.', r'\1', must_include=['a.b '],
+                          literal=True)
+        result = rpx.handle_file(str(version_file))
+        assert (result.matches, result.replacements) == (2, 2)
+        assert version_file.read() == 'a\\1b axb a\\1b\n'
+        with pytest.raises(repex.RepexError) as ex:
+            repex.Repex('a.b', '.', '-', must_include=['a.c'],
+                        literal=True).handle_file(str(version_file))
+        assert str(ex.value) == repex.ERRORS['prevalidation_failed']
+
+    def test_literal_stream(self, tmpdir):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write('(x)\nx\n(x) (x)\n')
+        result = repex.Repex('(x)', 'x', 'y', stream=True,
+                             literal=True).handle_file(str(version_file))
+        assert (result.matches, result.replacements) == (3, 3)
+        assert version_file.read() == '(y)\nx\n(y) (y)\n'
+
+    def test_required_literal_skips_file(self, tmpdir):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write('"date": "x"\n')
+        # A class with an escape can't be translated to a bytes regex
+        rpx = repex.Repex(r'"version": "[\d.]+"', 'm2', 'm3')
+        assert rpx.bytes_match_expression is None
+        assert rpx.is_known_unmatched(str(version_file))
+        version_file.write('"version": "3.1"\n')
+        assert not rpx.is_known_unmatched(str(version_file))
+        assert rpx.replace('"date": "x"') == ('"date": "x"', 0, False)
+
+    def test_literal_config_and_cli(self, tmpdir):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write('a.b axb\n')
+        repex.iterate(config={'paths': [{
+            'path': TEST_FILE_NAME,
+            'base_directory': str(tmpdir),
+            'match': 'a.b',
+            'replace': '.',
+            'with': '+',
+            'literal': True}]})
+        assert version_file.read() == 'a+b axb\n'
+        result = _invoke(['-b', str(tmpdir), TEST_FILE_NAME,
+                          '-r', '+', '-w', '$', '--literal'])
+        assert result.exit_code == 0
+        assert version_file.read() == 'a$b axb\n'
+
+
+class TestLiteralPrefilter():
+
+    def test_may_include(self, tmpdir):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write(u'abcd \xe9f')
+        prefilter = repex.LiteralPrefilter(
+            ['abc', 'bcd', 'cde', 'ab', u'\xe9f', None])
+        assert prefilter.may_include(str(version_file), 'abc')
+        assert prefilter.may_include(str(version_file), 'bcd')
+        assert prefilter.may_include(str(version_file), 'ab')
+        assert prefilter.may_include(str(version_file), u'\xe9f')
+        assert not prefilter.may_include(str(version_file), 'cde')
+        # Literals it doesn't know of might be included
+        assert prefilter.may_include(str(version_file), 'xyz')
+        assert (prefilter.scans, prefilter.hits) == (1, 4)
+
+        version_file.write('cde')
+        assert prefilter.may_include(str(version_file), 'cde')
+        assert not prefilter.may_include(str(version_file), 'abc')
+        assert prefilter.scans == 2
+
+    def test_scan_compiles_nothing(self, tmpdir, monkeypatch):
+        literals = ['key{0}: '.format(index) for index in range(40)]
+        prefilter = repex.LiteralPrefilter(literals)
+
+        def forbid_compile(*args, **kwargs):
+            raise AssertionError('Compiled a regex while scanning')
+
+        monkeypatch.setattr(re, 'compile', forbid_compile)
+        for index in range(10):
+            version_file = tmpdir.join('file{0}'.format(index))
+            version_file.write(''.join(literals[index:index + 5]))
+            for literal_index, literal in enumerate(literals):
+                assert prefilter.may_include(str(version_file), literal) == \
+                    (index <= literal_index < index + 5)
+        assert prefilter.scans == 10
+
+    def test_from_paths(self):
+        prefilter = repex.LiteralPrefilter.from_paths([
+            {'match': r'"version": "\d+"'},
+            {'match': '{{ .name }}: x+'},
+            {'match': 'a.b', 'literal': True},
+            {'match': '.*'}], {'name': 'date'})
+        assert prefilter.literals == set(['"version": "', 'date: x', 'a.b'])
+
+    def _path_object(self, base_dir, match, replace, replace_with, **kwargs):
+        path_object = _version_path_object(
+            base_dir, match=match, replace=replace, **{'with': replace_with})
+        path_object.update(kwargs)
+        return path_object
+
+    def test_iterate_scans_each_file_once(self, tmpdir, monkeypatch):
+        files = _create_version_files(tmpdir)
+        scanned_files = []
+        scan = repex.LiteralPrefilter._scan
+
+        def record_scan(prefilter, file_path):
+            scanned_files.append(file_path)
+            return scan(prefilter, file_path)
+
+        monkeypatch.setattr(repex.LiteralPrefilter, '_scan', record_scan)
+        repex.iterate(config={'paths': [
+            self._path_object(tmpdir, r'"version": "9\.{0}"'.format(index),
+                              '9', '8')
+            for index in range(5)]})
+        assert sorted(scanned_files) == sorted(files)
+
+    @pytest.mark.parametrize('stream', [False, True])
+    def test_paths_matching_replaced_content(self, tmpdir, stream):
+        files = _create_version_files(tmpdir)
+        repex.iterate(config={'paths': [
+            self._path_object(tmpdir, r'"version": "3\.1\.0-m2"', 'm2', 'm3',
+                              stream=stream),
+            self._path_object(tmpdir, r'"version": "3\.1\.0-m3"', 'm3', 'm4',
+                              stream=stream),
+            self._path_object(tmpdir, r'"date": "y"', 'y', 'z',
+                              stream=stream)]})
+        for version_file in files:
+            with open(version_file) as f:
+                assert f.read() == '"date": "x"\n"version": "3.1.0-m4"\n'
+
+
+class TestWorkers():
+
+    def _path_object(self, base_dir):
+        return _version_path_object(base_dir, must_include=['date'])
+
+    def test_handle_path_with_workers(self, tmpdir):
+        files = _create_version_files(tmpdir, 20)
+        repex.handle_path(self._path_object(tmpdir), workers=4)
+        for version_file in files:
+            with open(version_file) as f:
+                assert '"version": "3.1.0-m3"' in f.read()
+
+    def test_handle_path_with_workers_ordered_logging(self, tmpdir, caplog):
+        _create_version_files(tmpdir, 20)
+        expected_order = repex.get_all_files(
+            TEST_FILE_NAME, '.', str(tmpdir))
+        repex.handle_path(self._path_object(tmpdir), workers=4)
+        logged_order = [record.args[1] for record in caplog.records
+                        if record.msg.startswith('Found %s matches')]
+        assert logged_order == expected_order
+
+    def test_handle_path_with_workers_aggregates_errors(self, tmpdir):
+        files = _create_version_files(tmpdir, 6)
+        failing_files = files[1], files[4]
+        for failing_file in failing_files:
+            with open(failing_file, 'w') as f:
+                f.write('"version": "3.1.0-m2"\n')
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self._path_object(tmpdir), workers=3)
+        assert repex.ERRORS['files_failed'] in str(ex.value)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+        for version_file in files:
+            with open(version_file) as f:
+                content = f.read()
+            if version_file in failing_files:
+                assert version_file in str(ex.value)
+                assert '3.1.0-m2' in content
+            else:
+                assert version_file not in str(ex.value)
+                assert '3.1.0-m3' in content
+
+    def test_handle_path_stops_at_first_error(self, tmpdir, caplog):
+        _create_version_files(tmpdir, 6)
+        files = repex.get_all_files(TEST_FILE_NAME, '.', str(tmpdir))
+        with open(files[1], 'w') as f:
+            f.write('"version": "3.1.0-m2"\n')
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self._path_object(tmpdir))
+        assert str(ex.value) == repex.ERRORS['prevalidation_failed']
+        assert any(record.args == (files[1], ex.value)
+                   for record in caplog.records
+                   if record.msg.startswith('Failed to handle'))
+        for index, version_file in enumerate(files):
+            with open(version_file) as f:
+                assert ('3.1.0-m3' in f.read()) == (index == 0)
+
+
+class TestMustInclude():
+
+    CONTENT = '{\n  "date": "",\n  "version": "3.1.0-m2"\n}\n'
+
+    def _test_missing_strings(self, must_include, expected_missing):
+        rpx = repex.Repex('version', 'version', 'x', must_include=must_include)
+        missing = rpx.find_missing_strings(
+            self.CONTENT, rpx.must_include_expressions)
+        assert [e.pattern for e in missing] == expected_missing
+        assert [e.pattern for e in rpx.must_include_expressions
+                if not e.search(self.CONTENT)] == expected_missing
+
+    def test_all_found(self):
+        self._test_missing_strings(['date', 'version', r'\d+\.\d+'], [])
+
+    def test_overlapping_strings(self):
+        self._test_missing_strings(['version', 'ver', 'sion', 'ersio'], [])
+
+    def test_missing_strings(self):
+        self._test_missing_strings(
+            ['date', 'MISSING', 'version', '^version', 'OTHER'],
+            ['MISSING', '^version', 'OTHER'])
+
+    def test_anchored_strings(self):
+        self._test_missing_strings(['^{', '}$', '^  "date"'], ['^  "date"'])
+
+    def test_backreferences_not_combined(self):
+        self._test_missing_strings(
+            [r'(\d)\.\1', r'(")\1', 'date'], [r'(\d)\.\1'])
+
+    def test_conflicting_group_names_not_combined(self):
+        self._test_missing_strings(
+            ['(?P<x>date)', '(?P<x>version)', 'MISSING'], ['MISSING'])
+
+    def test_subsets_compile_nothing(self, monkeypatch):
+        rpx = repex.Repex('version', 'version', 'x',
+                          must_include=['date', 'version', 'MISSING'])
+
+        def forbid_compile(*args, **kwargs):
+            raise AssertionError('Compiled a regex while searching')
+
+        monkeypatch.setattr(re, 'compile', forbid_compile)
+        missing = rpx.must_include_expressions
+        for line in self.CONTENT.splitlines():
+            missing = rpx.find_missing_strings(line, missing)
+        assert [e.pattern for e in missing] == ['MISSING']
+
+
+class TestRegexRegistry():
+
+    def test_compile(self):
+        regexes = repex.RegexRegistry()
+        expression = regexes.compile('version')
+        assert expression.search('"version": "1"')
+        assert regexes.compile('version') is expression
+        assert regexes.compile('date') is not expression
+        assert (regexes.misses, regexes.hits) == (2, 1)
+
+    def _run(self, tmpdir, files_count):
+        base_dir = tmpdir.mkdir(str(files_count))
+        for index in range(files_count):
+            base_dir.mkdir('dir{0}'.format(index)).join(TEST_FILE_NAME).write(
+                '"date": "x"\n"version": "3.1.0-m2"\n')
+        config = {'paths': [{
+            'type': TEST_FILE_NAME,
+            'path': '{{ .path }}',
+            'base_directory': str(base_dir),
+            'match': '"version": "{{ .version }}"',
+            'replace': '{{ .version }}',
+            'with': '3.1.0-m3',
+            'must_include': ['date', 'version'],
+        }]}
+        # The same path twice, as if it was configured for multiple tags
+        config['paths'].append(dict(config['paths'][0]))
+        regexes = repex.RegexRegistry()
+        repex.iterate(config=config,
+                      variables={'path': '.', 'version': '3.1.0-m2'},
+                      regexes=regexes)
+        return regexes
+
+    def test_iterate_compiles_regexes_once(self, tmpdir):
+        few_files = self._run(tmpdir, 2)
+        many_files = self._run(tmpdir, 20)
+        assert many_files.misses == few_files.misses
+        assert many_files.hits == few_files.hits
+        assert many_files.hits >= many_files.misses
+
+
+class TestFileBuffer():
+
+    def _config(self, base_dir, **kwargs):
+        date_path = _version_path_object(
+            base_dir, match='"date": "x"', replace='x', **{'with': 'y'})
+        version_path = _version_path_object(
+            base_dir, must_include=['"date": "y"'])
+        version_path.update(kwargs)
+        return {'paths': [date_path, version_path]}
+
+    def _count_calls(self, monkeypatch, name):
+        calls = []
+        original = getattr(repex, name)
+
+        def counted(file_path, *args):
+            calls.append(file_path)
+            return original(file_path, *args)
+
+        monkeypatch.setattr(repex, name, counted)
+        return calls
+
+    def test_iterate_writes_each_file_once(self, tmpdir, monkeypatch):
+        files = _create_version_files(tmpdir)
+        writes = self._count_calls(monkeypatch, '_open_output')
+        repex.iterate(config=self._config(tmpdir))
+        assert sorted(writes) == sorted(files)
+        for version_file in files:
+            with open(version_file) as f:
+                assert f.read() == '"date": "y"\n"version": "3.1.0-m3"\n'
+
+    def _record_reads(self, monkeypatch):
+        reads = []
+        original_read = repex.FileBuffer.read
+
+        def read(file_buffer, file_path):
+            if file_path not in file_buffer:
+                reads.append(file_path)
+            return original_read(file_buffer, file_path)
+
+        monkeypatch.setattr(repex.FileBuffer, 'read', read)
+        return reads
+
+    def test_iterate_reads_changed_files_once(self, tmpdir, monkeypatch):
+        files = _create_version_files(tmpdir)
+        reads = self._record_reads(monkeypatch)
+        repex.iterate(config=self._config(tmpdir), workers=2)
+        assert sorted(reads) == sorted(files)
+
+    def test_iterate_reads_unchanged_files_per_path(self, tmpdir,
+                                                    monkeypatch):
+        files = _create_version_files(tmpdir, 1)
+        reads = self._record_reads(monkeypatch)
+        config = self._config(tmpdir, replace='MISSING', must_include=[])
+        config['paths'].reverse()
+        repex.iterate(config=config)
+        # Released once the first path left it unchanged
+        assert reads == files * 2
+
+    def test_only_changed_files_kept(self, tmpdir):
+        files = _create_version_files(tmpdir)
+        file_buffer = repex.FileBuffer()
+        date_path, version_path = self._config(tmpdir)['paths']
+        unchanged_path = dict(date_path, replace='z', **{'with': 'y'})
+        list(repex.iter_path_results(unchanged_path, file_buffer=file_buffer))
+        assert not any(version_file in file_buffer for version_file in files)
+        list(repex.iter_path_results(date_path, file_buffer=file_buffer))
+        assert all(file_buffer.is_changed(f) for f in files)
+        # Only the dry run keeps the original content around
+        assert [change.old_content for change in file_buffer.get_changes()
+                ] == [None] * 3
+        file_buffer.flush()
+        for version_file in files:
+            assert version_file not in file_buffer
+            with open(version_file) as f:
+                assert f.read() == '"date": "y"\n"version": "3.1.0-m2"\n'
+
+    def test_iterate_unchanged_file_not_written(self, tmpdir, monkeypatch):
+        _create_version_files(tmpdir, 1)
+        config = self._config(tmpdir)
+        revert_path = dict(config['paths'][0])
+        revert_path.update(
+            {'match': '"date": "y"', 'replace': 'y', 'with': 'x'})
+        config['paths'].append(revert_path)
+        config['paths'][1]['must_include'] = []
+        writes = self._count_calls(monkeypatch, '_open_output')
+        repex.iterate(config=config)
+        assert len(writes) == 1
+
+    def test_iterate_prevalidation_failure_writes_earlier_paths(self,
+                                                                tmpdir):
+        files = _create_version_files(tmpdir, 1)
+        config = self._config(tmpdir, must_include=['MISSING'])
+        with pytest.raises(repex.RepexError) as ex:
+            repex.iterate(config=config)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex)
+        with open(files[0]) as f:
+            assert f.read() == '"date": "y"\n"version": "3.1.0-m2"\n'
+
+    def test_iterate_validator_reads_earlier_paths(self, tmpdir):
+        files = _create_version_files(tmpdir, 1)
+        validator_file = tmpdir.join('date_validator.py')
+        validator_file.write(
+            'def validate(version_file, logger):\n'
+            '    with open(version_file) as f:\n'
+            '        return \'"date": "y"\' in f.read()\n')
+        for validator_type in ('per_file', 'per_type'):
+            config = self._config(tmpdir, validator={
+                'type': validator_type,
+                'path': str(validator_file),
+                'function': 'validate'})
+            config['paths'][1]['must_include'] = []
+            repex.iterate(config=config)
+            with open(files[0]) as f:
+                assert '"date": "y"' in f.read()
+            with open(files[0], 'w') as f:
+                f.write('"date": "x"\n"version": "3.1.0-m2"\n')
+
+    def test_iterate_to_file_reads_earlier_paths(self, tmpdir):
+        files = _create_version_files(tmpdir, 1)
+        output_file = str(tmpdir.join('output'))
+        config = self._config(tmpdir, to_file=output_file)
+        del config['paths'][1]['type']
+        config['paths'][1]['path'] = files[0]
+        repex.iterate(config=config)
+        with open(output_file) as f:
+            assert f.read() == '"date": "y"\n"version": "3.1.0-m3"\n'
+        with open(files[0]) as f:
+            assert f.read() == '"date": "y"\n"version": "3.1.0-m2"\n'
+
+
+class TestMatchCache():
+
+    CONTENT = VERSION_CONTENT
+
+    def _create_files(self, base_dir, count=3, age=60):
+        files = _create_version_files(base_dir, count)
+        for version_file in files:
+            os.utime(version_file, (time.time() - age,) * 2)
+        return files
+
+    def _run(self, base_dir, cache_dir, match='"version": "3.1.0-m3"'):
+        cache = repex.MatchCache(str(cache_dir))
+        repex.iterate(config={'paths': [_version_path_object(
+            base_dir, match=match, replace='3.1.0-m3',
+            **{'with': '3.1.0-m4'})]}, cache=cache)
+        return cache
+
+    def test_unmatched_files_skipped(self, tmpdir):
+        base_dir = tmpdir.mkdir('files')
+        self._create_files(base_dir)
+        first = self._run(base_dir, tmpdir.join('cache'))
+        assert (first.hits, first.misses) == (0, 3)
+        second = self._run(base_dir, tmpdir.join('cache'))
+        assert (second.hits, second.misses) == (3, 0)
+
+    def test_modified_file_handled(self, tmpdir):
+        base_dir = tmpdir.mkdir('files')
+        files = self._create_files(base_dir)
+        self._run(base_dir, tmpdir.join('cache'))
+        with open(files[0], 'w') as f:
+            f.write(self.CONTENT.replace('m2', 'm3'))
+        cache = self._run(base_dir, tmpdir.join('cache'))
+        assert (cache.hits, cache.misses) == (2, 1)
+        with open(files[0]) as f:
+            assert '"version": "3.1.0-m4"' in f.read()
+
+    def test_changed_rule_not_skipped(self, tmpdir):
+        base_dir = tmpdir.mkdir('files')
+        self._create_files(base_dir)
+        self._run(base_dir, tmpdir.join('cache'))
+        cache = self._run(base_dir, tmpdir.join('cache'), match='MISSING')
+        assert (cache.hits, cache.misses) == (0, 3)
+
+    def test_recently_modified_files_not_cached(self, tmpdir):
+        base_dir = tmpdir.mkdir('files')
+        self._create_files(base_dir, age=0)
+        self._run(base_dir, tmpdir.join('cache'))
+        cache = self._run(base_dir, tmpdir.join('cache'))
+        assert (cache.hits, cache.misses) == (0, 3)
+
+    def test_unused_entries_dropped(self, tmpdir):
+        base_dir = tmpdir.mkdir('files')
+        self._create_files(base_dir)
+        self._run(base_dir, tmpdir.join('cache'))
+        self._run(base_dir, tmpdir.join('cache'), match='MISSING')
+        cache = self._run(base_dir, tmpdir.join('cache'))
+        assert (cache.hits, cache.misses) == (0, 3)
+
+    def test_invalid_cache_ignored(self, tmpdir):
+        base_dir = tmpdir.mkdir('files')
+        self._create_files(base_dir)
+        cache_dir = tmpdir.mkdir('cache')
+        cache_dir.join(repex.CACHE_FILE_NAME).write('{invalid')
+        self._run(base_dir, cache_dir)
+        cache = self._run(base_dir, cache_dir)
+        assert (cache.hits, cache.misses) == (3, 0)
+
+    def test_cache_dir_cli(self, tmpdir, caplog):
+        base_dir = tmpdir.mkdir('files')
+        self._create_files(base_dir)
+        cache_dir = tmpdir.join('cache')
+        params = ['.', '-t', TEST_FILE_NAME, '-b', str(base_dir),
+                  '-r', 'MISSING', '-w', 'x', '--cache-dir', str(cache_dir)]
+        for _ in range(2):
+            result = _invoke(params)
+            assert result.exit_code == 0
+        assert cache_dir.join(repex.CACHE_FILE_NAME).check()
+        skipped = [record.args[:2] for record in caplog.records
+                   if record.msg.startswith('Skipped %s of %s files')]
+        assert skipped == [(0, 3), (3, 3)]
+
+
 class TestConfig():
 
     def test_import_config_file(self):
@@ -340,7 +1253,8 @@ class TestValidator():
         self.validator_config.update({'type': 'bad_type'})
         with pytest.raises(repex.RepexError) as ex:
             repex.iterate(config=self.validation_config)
-        assert "bad_type' is not one of ['per_type', 'per_file']" in str(ex)
+        assert "bad_type' is not one of ['per_type', 'per_file', 'batch']" \
+            in str(ex)
 
     def test_validator_path_not_found(self):
         self.validator_config.update({'path': 'bad_path'})
@@ -355,6 +1269,104 @@ class TestValidator():
             validator.validate('some_file')
         assert repex.ERRORS['validator_function_not_found'] in str(ex)
 
+    def test_validator_imported_once(self):
+        self.validator_config['path'] = os.path.join(
+            TEST_RESOURCES_DIR, 'validator.py')
+        validator = repex.Validator(self.validator_config)
+        other_validator = repex.Validator(dict(self.validator_config))
+        assert validator.validate('some_file')
+        function = validator._get_validation_function()
+        assert validator.validate('some_other_file')
+        assert validator._get_validation_function() is function
+        assert other_validator._get_validation_function() is function
+
+    def test_validator_imported_again_when_modified(self, tmpdir):
+        validator_path = tmpdir.join('validator.py')
+        validator_path.write('def validate(file_path, logger):\n'
+                             '    return True\n')
+        self.validator_config.update(
+            {'path': str(validator_path), 'function': 'validate'})
+        assert repex.Validator(self.validator_config).validate('some_file')
+        validator_path.write('def validate(file_path, logger):\n'
+                             '    return False\n')
+        validator_path.setmtime(validator_path.mtime() + 10)
+        assert not repex.Validator(self.validator_config).validate(
+            'some_file')
+
+    def _batch_path_object(self, tmpdir, function, **validator_config):
+        for index in range(3):
+            tmpdir.mkdir('dir{0}'.format(index)).join(TEST_FILE_NAME).write(
+                '"version": "3.1.0-m2"\n')
+        tmpdir.mkdir('unchanged').join(TEST_FILE_NAME).write(
+            '"version": "3.1.0-m3"\n')
+        validator_config.update({
+            'type': 'batch',
+            'path': os.path.join(TEST_RESOURCES_DIR, 'validator.py'),
+            'function': function})
+        return {
+            'type': TEST_FILE_NAME,
+            'path': '.',
+            'base_directory': str(tmpdir),
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0-m3',
+            'validator': validator_config
+        }
+
+    def _record_batch_calls(self, monkeypatch):
+        calls = []
+        validate_batch = repex.Validator.validate_batch
+
+        def recording_validate_batch(validator, written_files):
+            calls.append(sorted(w.path for w in written_files))
+            return validate_batch(validator, written_files)
+
+        monkeypatch.setattr(
+            repex.Validator, 'validate_batch', recording_validate_batch)
+        return calls
+
+    def test_batch_validator(self, tmpdir, monkeypatch):
+        calls = self._record_batch_calls(monkeypatch)
+        repex.handle_path(self._batch_path_object(
+            tmpdir, 'succeed_batch_validate'), workers=2)
+        assert calls == [
+            [str(tmpdir.join('dir{0}'.format(index), TEST_FILE_NAME))
+             for index in range(3)]]
+
+    def test_batch_validator_with_contents(self, tmpdir):
+        repex.handle_path(self._batch_path_object(
+            tmpdir, 'succeed_batch_validate', contents=True))
+
+    def test_written_contents_kept_only_for_batch_validator(self, tmpdir):
+        for contents in (False, True):
+            results = list(repex.iter_path_results(self._batch_path_object(
+                tmpdir.mkdir(str(contents)), 'succeed_batch_validate',
+                contents=contents)))
+            written = [result for result in results if result.written_file]
+            assert len(written) == 3
+            for result in written:
+                assert result.written_file.path == result.path
+                assert (result.written_file.content is not None) == contents
+
+    def test_batch_validator_with_contents_stream(self, tmpdir):
+        path_object = self._batch_path_object(
+            tmpdir, 'succeed_batch_validate', contents=True)
+        path_object['stream'] = True
+        repex.handle_path(path_object)
+
+    def test_failed_batch_validator(self, tmpdir):
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self._batch_path_object(
+                tmpdir, 'fail_batch_validate'))
+        assert repex.ERRORS['validation_failed'] in str(ex)
+
+    def test_batch_validator_nothing_written(self, tmpdir, monkeypatch):
+        calls = self._record_batch_calls(monkeypatch)
+        path_object = self._batch_path_object(tmpdir, 'fail_batch_validate')
+        path_object['with'] = '3.1.0-m2'
+        repex.handle_path(path_object)
+        assert calls == []
+
 
 class TestSingleFile():
 
@@ -471,6 +1483,248 @@ class TestSingleFile():
         assert not result
 
 
+class TestFileFilter():
+
+    def _create_files(self, base_dir):
+        base_dir.join('text.txt').write('"version": "3.1.0-m2"\n')
+        base_dir.join('empty.txt').write('')
+        base_dir.join('large.txt').write('"version": "3.1.0-m2"\n' * 100)
+        base_dir.join('image.PNG').write('"version": "3.1.0-m2"\n')
+        base_dir.join('archive.tar.gz').write('"version": "3.1.0-m2"\n')
+        base_dir.join('binary.txt').write_binary(
+            b'"version": "3.1.0-m2"\n\0\1\2')
+        # Beyond what's sniffed, a null byte doesn't make a file binary
+        base_dir.join('late.txt').write_binary(
+            b'"version": "3.1.0-m2"\n' + b' ' * repex.BINARY_SNIFF_SIZE +
+            b'\0')
+
+    def _get_file_names(self, base_dir, stats=None, **kwargs):
+        files = repex.get_all_files(
+            '.*', '.', str(base_dir), stats=stats,
+            file_filter=repex.FileFilter(**kwargs))
+        return sorted(os.path.basename(f) for f in files)
+
+    def test_no_filters(self, tmpdir):
+        self._create_files(tmpdir)
+        assert not repex.FileFilter()
+        assert repex.FileFilter.from_path({'skip_binary': False}) is None
+        assert len(self._get_file_names(tmpdir)) == 7
+
+    def test_size(self, tmpdir):
+        self._create_files(tmpdir)
+        stats = repex.RunStats()
+        assert self._get_file_names(
+            tmpdir, stats, min_size=1, max_size=100) == [
+                'archive.tar.gz', 'binary.txt', 'image.PNG', 'text.txt']
+        assert stats.counters['files_skipped_size'] == 3
+
+    def test_binary(self, tmpdir):
+        self._create_files(tmpdir)
+        stats = repex.RunStats()
+        names = self._get_file_names(tmpdir, stats, skip_binary=True)
+        assert 'binary.txt' not in names
+        assert 'late.txt' in names
+        assert stats.counters['files_skipped_binary'] == 1
+
+    def test_extensions(self, tmpdir):
+        self._create_files(tmpdir)
+        stats = repex.RunStats()
+        names = self._get_file_names(
+            tmpdir, stats, skipped_extensions=['png', '.tar.gz', 'xz'])
+        assert 'image.PNG' not in names
+        assert 'archive.tar.gz' not in names
+        assert stats.counters['files_skipped_extension'] == 2
+
+    def test_candidate_files(self, tmpdir):
+        self._create_files(tmpdir)
+        files = repex.get_all_files(
+            '.*', '.', str(tmpdir),
+            candidate_files=[str(tmpdir.join('binary.txt')),
+                             str(tmpdir.join('text.txt'))],
+            file_filter=repex.FileFilter(max_size=22, skip_binary=True))
+        assert files == [os.path.join(str(tmpdir), 'text.txt')]
+
+    def test_cli(self, tmpdir):
+        self._create_files(tmpdir)
+        result = _invoke(['.', '-t', r'.*\.(txt|PNG)', '-b', str(tmpdir),
+                          '-r', 'm2', '-w', 'm3', '--skip-binary',
+                          '--skip-extension', 'png', '--max-size', '1000',
+                          '--stats'])
+        assert result.exit_code == 0
+        assert 'Skipped 2 files by size, 1 binary files and 1 files by ' \
+            'extension' in result.output
+        assert tmpdir.join('text.txt').read() == '"version": "3.1.0-m3"\n'
+        for name in ('large.txt', 'late.txt', 'image.PNG', 'binary.txt'):
+            assert '3.1.0-m3' not in tmpdir.join(name).read_binary().decode()
+
+
+class TestIgnoreRules():
+
+    @pytest.mark.parametrize('pattern,path,is_dir,ignored', [
+        ('*.pyc', 'a/b/c.pyc', False, True),
+        ('*.pyc', 'c.pyc', False, True),
+        ('/build', 'build', True, True),
+        ('/build', 'a/build', True, False),
+        ('build/', 'a/build', True, True),
+        ('build/', 'build', False, False),
+        ('doc/frotz', 'doc/frotz', False, True),
+        ('doc/frotz', 'a/doc/frotz', False, False),
+        ('**/foo', 'a/b/foo', False, True),
+        ('**/foo', 'foo', False, True),
+        ('abc/**', 'abc/x/y', False, True),
+        ('a/**/b', 'a/b', False, True),
+        ('a/**/b', 'a/x/y/b', False, True),
+        ('a*b', 'a/b', False, False),
+        ('foo?', 'foox', False, True),
+        ('[!a]bc', 'xbc', False, True),
+        ('[!a]bc', 'abc', False, False),
+        ('\\#x', '#x', False, True),
+        ('*.txt  ', 'a.txt', False, True),
+    ])
+    def test_ignore_pattern_to_regex(self, pattern, path, is_dir, ignored):
+        expression, negated, directory_only = \
+            repex._ignore_pattern_to_regex(pattern)
+        assert not negated
+        assert (bool(expression.match(path)) and
+                (is_dir or not directory_only)) == ignored
+
+    def test_ignore_pattern_to_regex_no_pattern(self):
+        for line in ('', '  \n', '# comment', '!', '/'):
+            assert repex._ignore_pattern_to_regex(line) is None
+        assert repex._ignore_pattern_to_regex('!*.txt')[1]
+
+    def _create_tree(self, base_dir):
+        for path in ('src/a.txt', 'src/b.log', 'src/keep.log',
+                     'src/gen/c.txt', 'build/d.txt', 'build/sub/e.txt',
+                     'docs/build/f.txt', 'docs/g.txt', '.git/h.txt'):
+            base_dir.join(path).write('text', ensure=True)
+        base_dir.join('.gitignore').write('/build/\n*.log\n!keep.log\n')
+        base_dir.join('src', '.repexignore').write('gen/\n')
+        base_dir.join('docs', '.gitignore').write('# comment\n\nbuild\n')
+
+    def _get_relative_files(self, base_dir, **kwargs):
+        files = repex.get_all_files(r'.*\.(txt|log)', '.', str(base_dir),
+                                    **kwargs)
+        return sorted(os.path.relpath(f, str(base_dir)).replace(os.sep, '/')
+                      for f in files)
+
+    def test_get_all_files(self, tmpdir):
+        self._create_tree(tmpdir)
+        assert len(self._get_relative_files(tmpdir)) == 9
+
+        listed_dirs = []
+        directory_index = repex.DirectoryIndex()
+        scandir = directory_index.scandir
+
+        def record_scandir(path):
+            listed_dirs.append(os.path.relpath(path, str(tmpdir)))
+            return scandir(path)
+
+        directory_index.scandir = record_scandir
+        assert self._get_relative_files(
+            tmpdir, gitignore=True, directory_index=directory_index) == [
+                'docs/g.txt', 'src/a.txt', 'src/keep.log']
+        for ignored_dir in ('build', '.git', os.path.join('src', 'gen'),
+                            os.path.join('docs', 'build')):
+            assert ignored_dir not in listed_dirs
+
+    def test_rules_above_base_dir(self, tmpdir):
+        self._create_tree(tmpdir)
+        tmpdir.join('.git', 'info', 'exclude').write('g.txt\n', ensure=True)
+        assert self._get_relative_files(tmpdir.join('docs'),
+                                        gitignore=True) == []
+        assert self._get_relative_files(tmpdir.join('src'),
+                                        gitignore=True) == [
+                                            'a.txt', 'keep.log']
+        # Without a git repository, only rules under `base_dir` apply
+        tmpdir.join('.git').remove()
+        assert self._get_relative_files(tmpdir.join('src'),
+                                        gitignore=True) == [
+                                            'a.txt', 'b.log', 'keep.log']
+
+    def test_candidate_files(self, tmpdir):
+        self._create_tree(tmpdir)
+        files = repex.get_all_files(
+            r'.*\.txt', '.', str(tmpdir), gitignore=True,
+            candidate_files=[str(tmpdir.join('build', 'd.txt')),
+                             str(tmpdir.join('src', 'a.txt'))])
+        assert files == [os.path.join(str(tmpdir), 'src', 'a.txt')]
+
+    def test_cli(self, tmpdir):
+        self._create_tree(tmpdir)
+        result = _invoke(['.', '-t', r'.*\.txt', '-b', str(tmpdir),
+                          '-r', 'text', '-w', 'replaced', '--gitignore'])
+        assert result.exit_code == 0
+        assert tmpdir.join('src', 'a.txt').read() == 'replaced'
+        assert tmpdir.join('build', 'd.txt').read() == 'text'
+
+
+class TestExcludedPaths():
+
+    def test_explicit_paths(self):
+        excluded_paths = repex.ExcludedPaths(
+            'base', ['a/b/', './c//d', 'e/f.txt'])
+        assert excluded_paths.paths == set(
+            ['base/a/b', 'base/c/d', 'base/e/f.txt'])
+        for path in ('base/a/b', './base/a/b/g/h', 'base/c/d/i',
+                     'base/e/f.txt'):
+            assert excluded_paths.is_excluded(path), path
+        # Paths are compared by their components, not as strings
+        for path in ('base/a', 'base/a/bc', 'base/c', 'other/a/b', 'base'):
+            assert not excluded_paths.is_excluded(path), path
+        assert excluded_paths.is_excluded_file('./base/e//f.txt')
+        assert not excluded_paths.is_excluded_file('base/a/b/g')
+
+    def test_patterns(self):
+        excluded_paths = repex.ExcludedPaths(
+            './base', ['a/b'], ['*/build', '**/*.min.js'])
+        assert excluded_paths.is_excluded('base/x/build/y')
+        assert excluded_paths.is_excluded('base/x/y/z.min.js')
+        assert not excluded_paths.is_excluded('base/x/y/build')
+        assert not excluded_paths.is_excluded('other/x/build')
+        assert excluded_paths.is_excluded_file('base/x/y/z.min.js')
+        assert not excluded_paths.is_excluded_file('base/x/y/z.js')
+
+    def test_no_excluded_paths(self):
+        excluded_paths = repex.ExcludedPaths('base')
+        assert not excluded_paths
+        assert not excluded_paths.is_excluded('base/a')
+        assert not excluded_paths.is_excluded_file('base/a')
+
+    def test_get_all_files(self, tmpdir):
+        for path in ('a/VERSION', 'ab/VERSION', 'c/build/VERSION',
+                     'c/d/VERSION', 'e/VERSION', 'e/VERSION.min.js'):
+            tmpdir.join(path).write('', ensure=True)
+        files = repex.get_all_files(
+            'VERSION.*', '.', str(tmpdir),
+            excluded_paths=['a', 'c/d/VERSION'],
+            excluded_patterns=['*/build', '**/*.min.js'])
+        assert sorted(os.path.relpath(f, str(tmpdir)) for f in files) == [
+            os.path.join('ab', 'VERSION'), os.path.join('e', 'VERSION')]
+
+    def test_explicit_paths_with_glob_characters(self, tmpdir):
+        for path in ('pages/[id]/VERSION', 'pages/d/VERSION',
+                     'pages/x?/VERSION', 'pages/xy/VERSION'):
+            tmpdir.join(path).write('', ensure=True)
+        files = repex.get_all_files(
+            'VERSION', '.', str(tmpdir),
+            excluded_paths=['pages/[id]', 'pages/x?'])
+        assert sorted(os.path.relpath(f, str(tmpdir)) for f in files) == [
+            os.path.join('pages', 'd', 'VERSION'),
+            os.path.join('pages', 'xy', 'VERSION')]
+
+    def test_exclude_pattern_cli(self, tmpdir):
+        for path in ('a/build/VERSION', 'a/src/VERSION', 'build/VERSION'):
+            tmpdir.join(path).write('1.0', ensure=True)
+        result = _invoke(['.', '-t', 'VERSION', '-b', str(tmpdir),
+                          '-r', '1.0', '-w', '2.0',
+                          '--exclude-pattern', '*/build'])
+        assert result.exit_code == 0
+        assert tmpdir.join('a', 'build', 'VERSION').read() == '1.0'
+        assert tmpdir.join('a', 'src', 'VERSION').read() == '2.0'
+        assert tmpdir.join('build', 'VERSION').read() == '2.0'
+
+
 class TestGetAllFiles():
 
     def setup_method(self, test_method):
@@ -530,3 +1784,607 @@ class TestGetAllFiles():
         assert len(mock_yaml_files) == len(files)
         for f in mock_yaml_files:
             assert os.path.join(TEST_RESOURCES_DIR, f) in files
+
+    def _get_walked_dirs(self, monkeypatch, **kwargs):
+        walked_dirs = []
+        scandir = os.scandir
+
+        def recording_scandir(path):
+            walked_dirs.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr(repex.os, 'scandir', recording_scandir)
+        files = repex.get_all_files(**kwargs)
+        return files, walked_dirs
+
+    def test_get_all_files_excluded_dirs_not_walked(self, monkeypatch):
+        files, walked_dirs = self._get_walked_dirs(
+            monkeypatch,
+            filename_regex=TEST_FILE_NAME,
+            path=TEST_RESOURCES_DIR_PATTERN,
+            base_dir=TEST_RESOURCES_DIR,
+            excluded_paths=['multiple/excluded'])
+        assert EXCLUDED_FILE not in files
+        assert os.path.join(MULTIPLE_DIR, 'excluded') not in walked_dirs
+        assert os.path.join(MULTIPLE_DIR, 'folders') in walked_dirs
+
+    def test_get_all_files_anchored_path_prunes_dirs(self, monkeypatch):
+        files, walked_dirs = self._get_walked_dirs(
+            monkeypatch,
+            filename_regex=TEST_FILE_NAME,
+            path='^tests/resources/multiple/folders',
+            base_dir=TEST_RESOURCES_DIR)
+        assert files == [
+            os.path.join(MULTIPLE_DIR, 'folders', TEST_FILE_NAME)]
+        assert os.path.join(TEST_RESOURCES_DIR, 'single') not in walked_dirs
+        assert os.path.join(MULTIPLE_DIR, 'excluded') not in walked_dirs
+
+    def test_get_anchored_prefix(self):
+        assert repex._get_anchored_prefix('tests/resources') is None
+        assert repex._get_anchored_prefix('^a|^b') is None
+        assert repex._get_anchored_prefix('^tests/res.*') == 'tests/res'
+        assert repex._get_anchored_prefix(r'^a\.b\d') == 'a.b'
+        assert repex._get_anchored_prefix('^abc?') == 'ab'
+        assert repex._get_anchored_prefix('^ab{2}') == 'a'
+        assert repex._get_anchored_prefix('^ab+') == 'ab'
+        assert repex._get_anchored_prefix('^(ab)') == ''
+
+    def test_get_all_files_shared_directory_index(self, monkeypatch):
+        directory_index = repex.DirectoryIndex()
+        files, walked_dirs = self._get_walked_dirs(
+            monkeypatch,
+            filename_regex=TEST_FILE_NAME,
+            path=TEST_RESOURCES_DIR_PATTERN,
+            base_dir=TEST_RESOURCES_DIR,
+            excluded_paths=['multiple/excluded'],
+            directory_index=directory_index)
+        assert walked_dirs
+        other_files, walked_dirs = self._get_walked_dirs(
+            monkeypatch,
+            filename_regex='mock.*',
+            path=TEST_RESOURCES_DIR_PATTERN,
+            base_dir=TEST_RESOURCES_DIR,
+            directory_index=directory_index)
+        assert walked_dirs == [os.path.join(MULTIPLE_DIR, 'excluded')]
+        assert EXCLUDED_FILE not in files
+        assert EXCLUDED_FILE in other_files
+        assert set(files) < set(other_files)
+
+    def test_directory_index_forget(self, tmpdir):
+        directory_index = repex.DirectoryIndex()
+        tmpdir.join('a').write('')
+        assert [e.name for e in directory_index.scandir(str(tmpdir))] == \
+            ['a']
+        tmpdir.join('b').write('')
+        assert len(directory_index.scandir(str(tmpdir))) == 1
+        directory_index.forget(os.path.join(str(tmpdir), '.'))
+        assert sorted(e.name for e in directory_index.scandir(
+            str(tmpdir))) == ['a', 'b']
+
+    def test_iterate_walks_once(self, tmpdir, monkeypatch):
+        for name in ('a', 'b'):
+            tmpdir.mkdir(name).join(TEST_FILE_NAME).write('version: 1\n')
+        path = {
+            'type': TEST_FILE_NAME,
+            'path': '.',
+            'base_directory': str(tmpdir),
+            'match': 'version: 1',
+            'replace': '1',
+            'with': '2',
+        }
+        other_path = dict(path)
+        other_path.update({'match': 'version: 2', 'replace': '2', 'with': '3'})
+        config = {'paths': [path, other_path]}
+        walked_dirs = []
+        scandir = os.scandir
+
+        def recording_scandir(path):
+            walked_dirs.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr(repex.os, 'scandir', recording_scandir)
+        repex.iterate(config=config)
+        assert sorted(walked_dirs) == sorted(
+            [str(tmpdir)] + [str(tmpdir.join(name)) for name in ('a', 'b')])
+        for name in ('a', 'b'):
+            assert tmpdir.join(name, TEST_FILE_NAME).read() == 'version: 3\n'
+
+
+class TestCandidateFiles():
+
+    def _get_candidate_files(self, monkeypatch, candidate_files, **kwargs):
+        def fail_scandir(path):
+            raise AssertionError('{0} was walked'.format(path))
+
+        monkeypatch.setattr(repex.os, 'scandir', fail_scandir)
+        return repex.get_all_files(
+            filename_regex=TEST_FILE_NAME,
+            path=TEST_RESOURCES_DIR_PATTERN,
+            base_dir=TEST_RESOURCES_DIR,
+            candidate_files=candidate_files,
+            **kwargs)
+
+    def test_get_all_files_filters_candidates(self, monkeypatch):
+        all_files = [os.path.join(root, f)
+                     for root, _, files in os.walk(TEST_RESOURCES_DIR)
+                     for f in files]
+        walked_files = repex.get_all_files(
+            filename_regex=TEST_FILE_NAME,
+            path=TEST_RESOURCES_DIR_PATTERN,
+            base_dir=TEST_RESOURCES_DIR,
+            excluded_paths=['multiple/excluded'])
+        candidate_files = all_files + [
+            os.path.abspath(walked_files[0]),
+            os.path.join(MULTIPLE_DIR, 'missing', TEST_FILE_NAME),
+            os.path.join('tests', TEST_FILE_NAME),
+            'setup.py']
+        files = self._get_candidate_files(
+            monkeypatch, candidate_files,
+            excluded_paths=['multiple/excluded'])
+        assert sorted(files) == sorted(walked_files)
+        assert EXCLUDED_FILE not in files
+
+    def test_get_all_files_no_candidates(self, monkeypatch):
+        assert self._get_candidate_files(monkeypatch, []) == []
+
+    def _path_object(self, base_dir):
+        return {
+            'path': str(base_dir.join(TEST_FILE_NAME)),
+            'match': 'version: 1',
+            'replace': '1',
+            'with': '2',
+        }
+
+    def test_single_file_not_candidate_skipped(self, tmpdir):
+        version_file = tmpdir.join(TEST_FILE_NAME)
+        version_file.write('version: 1\n')
+        repex.handle_path(self._path_object(tmpdir),
+                          candidate_files=[str(tmpdir.join('other'))])
+        assert version_file.read() == 'version: 1\n'
+        repex.handle_path(self._path_object(tmpdir),
+                          candidate_files=[str(version_file)])
+        assert version_file.read() == 'version: 2\n'
+
+    def test_files_from_stdin(self, tmpdir):
+        for name in ('a', 'b'):
+            tmpdir.mkdir(name).join(TEST_FILE_NAME).write('version: 1\n')
+        result = clicktest.CliRunner().invoke(
+            getattr(repex, 'main'),
+            ['.', '-t', TEST_FILE_NAME, '-b', str(tmpdir),
+             '-r', '1', '-w', '2', '--files-from', '-'],
+            input='\n{0}\n'.format(tmpdir.join('a', TEST_FILE_NAME)))
+        assert result.exit_code == 0
+        assert tmpdir.join('a', TEST_FILE_NAME).read() == 'version: 2\n'
+        assert tmpdir.join('b', TEST_FILE_NAME).read() == 'version: 1\n'
+
+    def test_git_diff(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(str(tmpdir))
+        for name in ('a', 'b'):
+            tmpdir.mkdir(name).join(TEST_FILE_NAME).write('version: 1\n')
+        subprocess.check_call(['git', 'init', '-q'])
+        subprocess.check_call(['git', 'add', '.'])
+        subprocess.check_call(
+            ['git', '-c', 'user.name=repex', '-c', 'user.email=repex@test',
+             'commit', '-q', '-m', 'Add files'])
+        tmpdir.join('a', TEST_FILE_NAME).write('version: 1\nbuild: 1\n')
+        assert repex.get_git_diff_files('HEAD') == [
+            os.path.join(os.path.realpath(str(tmpdir)), 'a', TEST_FILE_NAME)]
+        result = _invoke(['.', '-t', TEST_FILE_NAME, '-b', str(tmpdir),
+                          '-m', 'version: 1', '-r', '1', '-w', '2',
+                          '--git-diff', 'HEAD'])
+        assert result.exit_code == 0
+        assert tmpdir.join('a', TEST_FILE_NAME).read() == \
+            'version: 2\nbuild: 1\n'
+        assert tmpdir.join('b', TEST_FILE_NAME).read() == 'version: 1\n'
+
+    def test_git_diff_failed(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(str(tmpdir))
+        with pytest.raises(repex.RepexError) as ex:
+            repex.get_git_diff_files('HEAD')
+        assert repex.ERRORS['git_diff_failed'] in str(ex)
+
+
+class TestAsync():
+
+    def _path_object(self, base_dir, **kwargs):
+        path_object = _version_path_object(base_dir, must_include=['date'])
+        path_object.update(kwargs)
+        return path_object
+
+    def _collect(self, results, limit=None):
+        async def collect():
+            collected = []
+            try:
+                async for result in results:
+                    collected.append(result)
+                    if len(collected) == limit:
+                        break
+            finally:
+                await results.aclose()
+            return collected
+
+        return asyncio.run(collect())
+
+    def _read(self, files):
+        contents = []
+        for version_file in files:
+            with open(version_file) as f:
+                contents.append(f.read())
+        return contents
+
+    def test_ahandle_path(self, tmpdir):
+        _create_version_files(tmpdir, 5)
+        expected_files = repex.get_all_files(
+            TEST_FILE_NAME, '.', str(tmpdir))
+        results = self._collect(repex.ahandle_path(
+            self._path_object(tmpdir), workers=3))
+        assert [result.path for result in results] == expected_files
+        for result in results:
+            assert result.written_file.path == result.path
+        for content in self._read(expected_files):
+            assert '"version": "3.1.0-m3"' in content
+
+    def test_aiterate(self, tmpdir):
+        files = _create_version_files(tmpdir, 5)
+        config = {'paths': [
+            self._path_object(tmpdir),
+            self._path_object(tmpdir, match='"date": "x"', replace='x',
+                              **{'with': 'y'})]}
+        results = self._collect(repex.aiterate(config=config, workers=2))
+        assert len(results) == 2 * len(files)
+        for content in self._read(files):
+            assert content == '"date": "y"\n"version": "3.1.0-m3"\n'
+
+    def test_aiterate_closed(self, tmpdir):
+        _create_version_files(tmpdir, 5)
+        files = repex.get_all_files(TEST_FILE_NAME, '.', str(tmpdir))
+        results = self._collect(repex.aiterate(
+            config={'paths': [self._path_object(tmpdir)]}), limit=2)
+        assert [result.path for result in results] == files[:2]
+        contents = self._read(files)
+        for content in contents[:2]:
+            assert '"version": "3.1.0-m3"' in content
+        for content in contents[2:]:
+            assert '"version": "3.1.0-m2"' in content
+
+    def test_aiterate_cancelled(self, tmpdir):
+        _create_version_files(tmpdir, 5)
+        files = repex.get_all_files(TEST_FILE_NAME, '.', str(tmpdir))
+
+        async def run():
+            handled = asyncio.Event()
+
+            async def consume():
+                results = repex.aiterate(
+                    config={'paths': [self._path_object(tmpdir)]})
+                try:
+                    async for _ in results:
+                        handled.set()
+                        await asyncio.sleep(10)
+                finally:
+                    await results.aclose()
+
+            task = asyncio.ensure_future(consume())
+            await handled.wait()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        contents = self._read(files)
+        assert '"version": "3.1.0-m3"' in contents[0]
+        for content in contents[1:]:
+            assert '"version": "3.1.0-m2"' in content
+
+    def test_ahandle_path_failure(self, tmpdir):
+        _create_version_files(tmpdir, 1)
+        with pytest.raises(repex.RepexError) as ex:
+            self._collect(repex.ahandle_path(
+                self._path_object(tmpdir, must_include=['MISSING'])))
+        assert repex.ERRORS['prevalidation_failed'] in str(ex)
+
+
+class TestResults():
+
+    CONTENT = VERSION_CONTENT + '"other": "3.1.0-m2"\n'
+
+    def _create_files(self, base_dir, count=3):
+        return _create_version_files(base_dir, count, self.CONTENT)
+
+    def _path_object(self, base_dir, **kwargs):
+        path_object = _version_path_object(
+            base_dir, match='"3.1.0-m.*"', replace='m2', **{'with': 'm3'})
+        path_object.update(kwargs)
+        return path_object
+
+    def test_iter_results(self, tmpdir):
+        self._create_files(tmpdir)
+        files = repex.get_all_files(TEST_FILE_NAME, '.', str(tmpdir))
+        results = list(repex.iter_results(
+            config={'paths': [self._path_object(tmpdir)]}))
+        assert [result.path for result in results] == files
+        for result in results:
+            assert (result.matches, result.replacements) == (2, 2)
+            assert result.bytes_written == os.path.getsize(result.path)
+            assert result.duration >= 0
+            assert result.validated is None
+            assert result.written_file.path == result.path
+
+    def test_iter_results_unchanged(self, tmpdir):
+        self._create_files(tmpdir, 1)
+        results = list(repex.iter_results(config={'paths': [
+            self._path_object(tmpdir, replace='m4')]}))
+        assert len(results) == 1
+        assert (results[0].matches, results[0].replacements) == (2, 0)
+        assert results[0].bytes_written == 0
+        assert results[0].written_file is None
+
+    def test_iter_results_closed(self, tmpdir):
+        self._create_files(tmpdir)
+        files = repex.get_all_files(TEST_FILE_NAME, '.', str(tmpdir))
+        results = repex.iter_results(
+            config={'paths': [self._path_object(tmpdir)]})
+        assert next(results).path == files[0]
+        results.close()
+        with open(files[0]) as f:
+            assert '3.1.0-m3' in f.read()
+        for version_file in files[1:]:
+            with open(version_file) as f:
+                assert f.read() == self.CONTENT
+
+    def test_iter_path_results_with_workers(self, tmpdir):
+        self._create_files(tmpdir, 10)
+        files = repex.get_all_files(TEST_FILE_NAME, '.', str(tmpdir))
+        results = list(repex.iter_path_results(
+            self._path_object(tmpdir), workers=4))
+        assert [result.path for result in results] == files
+        assert all(result.written_file for result in results)
+
+    def test_iter_path_results_validated(self, tmpdir):
+        self._create_files(tmpdir)
+        results = list(repex.iter_path_results(self._path_object(
+            tmpdir, validator={
+                'type': 'per_file',
+                'path': os.path.join(TEST_RESOURCES_DIR, 'validator.py'),
+                'function': 'succeed_validate'})))
+        assert [result.validated for result in results] == [True] * 3
+
+    def test_stream_result(self, tmpdir):
+        version_file = self._create_files(tmpdir, 1)[0]
+        result = repex.Repex(
+            '"3.1.0-m.*"', 'm2', 'm3', stream=True).handle_file(version_file)
+        assert (result.matches, result.replacements) == (2, 2)
+        assert result.bytes_written == os.path.getsize(version_file)
+        assert result.written_file == repex.WrittenFile(version_file, None)
+
+
+class TestDryRun():
+
+    CONTENT = VERSION_CONTENT
+
+    def _forbid_writes(self, monkeypatch):
+        def fail_mkstemp(*args, **kwargs):
+            raise AssertionError('A file was written')
+
+        monkeypatch.setattr(repex.tempfile, 'mkstemp', fail_mkstemp)
+
+    def _read(self, files):
+        contents = []
+        for version_file in files:
+            with open(version_file) as f:
+                contents.append(f.read())
+        return contents
+
+    def test_iterate_dry_run(self, tmpdir, monkeypatch):
+        self._forbid_writes(monkeypatch)
+        files = sorted(_create_version_files(tmpdir, 2))
+        date_path = _version_path_object(
+            tmpdir, match='"date": "x"', replace='x', **{'with': 'y'})
+        changes = repex.iterate(config={'paths': [
+            _version_path_object(tmpdir), date_path]}, dry_run=True)
+        assert sorted(change.path for change in changes) == files
+        for change in changes:
+            assert change.old_content == self.CONTENT
+            assert change.new_content == \
+                '"date": "y"\n"version": "3.1.0-m3"\n'
+        assert self._read(files) == [self.CONTENT] * 2
+
+    def test_iterate_dry_run_to_file(self, tmpdir, monkeypatch):
+        self._forbid_writes(monkeypatch)
+        version_file = _create_version_files(tmpdir, 1)[0]
+        output_file = str(tmpdir.join('output'))
+        to_file_path = _version_path_object(
+            tmpdir, path=version_file, to_file=output_file)
+        del to_file_path['type']
+        output_path = _version_path_object(
+            tmpdir, path=output_file, match='"date": "x"', replace='x',
+            **{'with': 'y'})
+        del output_path['type']
+        changes = repex.iterate(
+            config={'paths': [to_file_path, output_path]}, dry_run=True)
+        assert changes == [repex.FileChange(
+            output_file, None, '"date": "y"\n"version": "3.1.0-m3"\n')]
+        assert not os.path.exists(output_file)
+        assert repex.get_diff(changes[0]).startswith(
+            '--- {0}\n+++ {1}\n'.format(os.devnull, output_file))
+
+    def test_dry_run_skips_validation_and_stream(self, tmpdir, monkeypatch):
+        self._forbid_writes(monkeypatch)
+        files = _create_version_files(tmpdir, 2)
+        changes = repex.iterate(config={'paths': [_version_path_object(
+            tmpdir, stream=True, validator={
+                'type': 'per_file',
+                'path': os.path.join(TEST_RESOURCES_DIR, 'validator.py'),
+                'function': 'fail_validate'})]}, dry_run=True)
+        assert len(changes) == 2
+        assert self._read(files) == [self.CONTENT] * 2
+
+    def test_dry_run_cli(self, tmpdir):
+        files = _create_version_files(tmpdir, 2)
+        params = ['.', '-t', TEST_FILE_NAME, '-b', str(tmpdir),
+                  '-r', '3.1.0-m2', '-w', '3.1.0-m3']
+        result = _invoke(params + ['--dry-run'])
+        assert result.exit_code == 0
+        for version_file in files:
+            assert 'Would write {0} (+1 -1 lines)'.format(version_file) \
+                in result.output
+        assert '2 files would be written' in result.output
+        result = _invoke(params + ['--diff'])
+        assert result.exit_code == 0
+        for version_file in files:
+            assert '--- {0}\n+++ {0}\n'.format(version_file) \
+                in result.output
+        assert '-"version": "3.1.0-m2"\n+"version": "3.1.0-m3"\n' \
+            in result.output
+        assert self._read(files) == [self.CONTENT] * 2
+
+    def test_diff_cli_stdout_only_has_diff(self, tmpdir):
+        files = _create_version_files(tmpdir, 2)
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'import repex; repex.main()',
+             '.', '-t', TEST_FILE_NAME, '-b', str(tmpdir),
+             '-r', '3.1.0-m2', '-w', '3.1.0-m3', '--diff'],
+            cwd=os.path.dirname(os.path.abspath(repex.__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        stdout, stderr = process.communicate()
+        assert process.returncode == 0
+        assert stdout == ''.join(repex.get_diff(repex.FileChange(
+            version_file, self.CONTENT,
+            self.CONTENT.replace('m2', 'm3')))
+            for version_file in repex.get_all_files(
+                TEST_FILE_NAME, '.', str(tmpdir)))
+        assert 'Handling path' in stderr
+        assert self._read(files) == [self.CONTENT] * 2
+
+
+class TestRunStats():
+
+    CONTENT = VERSION_CONTENT
+
+    def _create_files(self, base_dir):
+        files = _create_version_files(base_dir)
+        for version_file in files:
+            other_file = os.path.join(os.path.dirname(version_file), 'other')
+            with open(other_file, 'w') as f:
+                f.write(self.CONTENT)
+        # The first file has nothing to replace
+        with open(files[0], 'w') as f:
+            f.write(self.CONTENT.replace('m2', 'm4'))
+        return files
+
+    def _path_object(self, base_dir, **kwargs):
+        path_object = _version_path_object(
+            base_dir, match='"version": "3.1.0-m.*"', replace='m2',
+            **{'with': 'm3'})
+        path_object.update(kwargs)
+        return path_object
+
+    def test_iterate_stats(self, tmpdir):
+        files = self._create_files(tmpdir)
+        stats = repex.RunStats()
+        repex.iterate(config={'paths': [self._path_object(tmpdir)]},
+                      stats=stats)
+        report = stats.get_report()
+        assert report['files_walked'] == 6
+        assert report['files_handled'] == 3
+        assert report['files_matched'] == 3
+        assert report['files_written'] == 2
+        assert report['bytes_written'] == 2 * len(self.CONTENT)
+        assert report['bytes_read'] >= 3 * len(self.CONTENT)
+        assert set(report['phases']) == set(repex.RunStats.PHASES)
+        assert all(duration >= 0 for duration in report['phases'].values())
+        assert sorted(f['path'] for f in report['slowest_files']) == \
+            sorted(files)
+        durations = [f['duration'] for f in report['slowest_files']]
+        assert durations == sorted(durations, reverse=True)
+
+    def test_stats_count_each_write_and_walk_once(self, tmpdir):
+        files = self._create_files(tmpdir)
+        stats = repex.RunStats()
+        repex.iterate(config={'paths': [
+            self._path_object(tmpdir, replace='m2', **{'with': 'm3'}),
+            self._path_object(tmpdir, replace='m3', **{'with': 'm5'}),
+            self._path_object(tmpdir, replace='m5', **{'with': 'm6'}),
+        ]}, stats=stats)
+        report = stats.get_report()
+        assert report['files_walked'] == 6
+        assert report['files_handled'] == 9
+        assert report['files_written'] == 2
+        assert report['bytes_written'] == sum(
+            os.path.getsize(f) for f in files[1:])
+        # The unchanged file is read by each path while the others are
+        # only read once and then kept in the buffer
+        assert report['bytes_read'] == 5 * len(self.CONTENT)
+
+    def test_stream_bytes_read_once(self, tmpdir):
+        self._create_files(tmpdir)
+        stats = repex.RunStats()
+        repex.handle_path(self._path_object(tmpdir, stream=True),
+                          stats=stats)
+        report = stats.get_report()
+        assert report['files_written'] == 2
+        assert report['bytes_written'] == 2 * len(self.CONTENT)
+        assert report['bytes_read'] == 3 * len(self.CONTENT)
+
+    def test_stream_and_validate_stats(self, tmpdir):
+        self._create_files(tmpdir)
+        stats = repex.RunStats()
+        repex.handle_path(self._path_object(tmpdir, stream=True, validator={
+            'type': 'per_file',
+            'path': os.path.join(TEST_RESOURCES_DIR, 'validator.py'),
+            'function': 'succeed_validate'}), stats=stats)
+        report = stats.get_report()
+        assert report['files_handled'] == 3
+        assert report['files_written'] == 2
+        assert report['phases']['validate'] > 0
+        assert report['phases']['write'] > 0
+
+    def test_slowest_files_limit(self):
+        stats = repex.RunStats()
+        for index in range(5):
+            stats.add_result(repex.FileResult(
+                'file{0}'.format(index), 0, 0, 0, index, None, None))
+        report = stats.get_report(slowest_files=2)
+        assert report['files_handled'] == 5
+        assert report['files_matched'] == 0
+        assert report['slowest_files'] == [
+            {'path': 'file4', 'duration': 4},
+            {'path': 'file3', 'duration': 3}]
+        assert 'Slowest files:\n  4.000s file4\n' in stats.get_summary()
+
+    def test_stats_cli(self, tmpdir):
+        self._create_files(tmpdir)
+        stats_file = str(tmpdir.join('stats.json'))
+        result = _invoke(['.', '-t', TEST_FILE_NAME, '-b', str(tmpdir),
+                          '-r', '3.1.0-m2', '-w', '3.1.0-m3', '--stats',
+                          '--stats-file', stats_file])
+        assert result.exit_code == 0
+        assert 'Walked 6 files and handled 3 in ' in result.output
+        assert '2 files matched and 2 were written' in result.output
+        assert 'Time per phase: expand ' in result.output
+        with open(stats_file) as f:
+            report = json.load(f)
+        assert report['files_written'] == 2
+        assert len(report['slowest_files']) == 3
+
+    def test_profile_cli(self, tmpdir):
+        self._create_files(tmpdir)
+        profile_file = str(tmpdir.join('repex.prof'))
+        result = _invoke(['.', '-t', TEST_FILE_NAME, '-b', str(tmpdir),
+                          '-r', '3.1.0-m2', '-w', '3.1.0-m3',
+                          '--profile', profile_file])
+        assert result.exit_code == 0
+        assert 'Wrote profile to {0}'.format(profile_file) in result.output
+        assert 'Ordered by: cumulative time' in result.output
+        profile_stats = pstats.Stats(profile_file)
+        assert any(function == 'handle_path' for _, _, function
+                   in profile_stats.stats)
+
+    def test_profile_cli_failed_run(self, tmpdir):
+        profile_file = str(tmpdir.join('repex.prof'))
+        result = _invoke(['missing_file', '-b', str(tmpdir),
+                          '-r', '3.1.0-m2', '-w', '3.1.0-m3',
+                          '--profile', profile_file])
+        assert result.exit_code != 0
+        assert os.path.isfile(profile_file)